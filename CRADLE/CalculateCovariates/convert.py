@@ -0,0 +1,27 @@
+import sys
+import time
+
+from CRADLE.correctbiasutils import covariateStore
+from CRADLE.logging import timer
+
+
+@timer("CONVERTING COVARIATE FILES")
+def convertCovariates(covariDir, outputDir):
+	npyFileNames = covariateStore.convertHDF5Store(covariDir, outputDir)
+
+	print("* Output file names: ")
+	print(f"{npyFileNames}\n")
+
+
+def run(args):
+	startTime = time.perf_counter()
+
+	covariDir = args.covariDir.rstrip("/")
+	outputDir = covariDir if args.o is None else args.o.rstrip("/")
+
+	try:
+		convertCovariates(covariDir, outputDir)
+	except covariateStore.CovariateStoreException as e:
+		sys.exit(f"Error: {e}")
+
+	print(f"-- RUNNING TIME: {((time.perf_counter() - startTime)/3600)} hour(s)")
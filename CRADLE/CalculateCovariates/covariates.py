@@ -9,6 +9,7 @@ import h5py
 import py2bit
 
 import CRADLE.correctbiasutils as utils
+import CRADLE.correctbiasutils.shard as shard
 
 from typing import List, Tuple
 
@@ -30,16 +31,13 @@ def outputHDF5File(outputDir, baseName, chromo):
 	return os.path.join(outputDir, f"{baseName}_{chromo}.hdf5")
 
 
-def mergeTempFilesToHDF5(chromo, regionGroup, outputFile):
-	with py2bit.open(vari.GENOME) as genome:
-		chromoEnd = int(genome.chroms(chromo))
-
+def mergeTempFilesToHDF5(chromo, regionGroup, outputFile, chromoEnd, covariNum, tempDir):
 	f = h5py.File(outputFile, "w")
-	covariDataSet = f.create_dataset("covari", (chromoEnd, vari.COVARI_NUM), dtype='f', compression="gzip")
+	covariDataSet = f.create_dataset("covari", (chromoEnd, covariNum), dtype='f', compression="gzip")
 
 	for chromo, analysisStart, analysisEnd in regionGroup:
 		print(f"{chromo}:{analysisStart}-{analysisEnd}")
-		tempFileName = os.path.join(commonVari.OUTPUT_DIR, f"{chromo}_{analysisStart}_{analysisEnd}.pkl")
+		tempFileName = os.path.join(tempDir, f"{chromo}_{analysisStart}_{analysisEnd}.pkl")
 		with open(tempFileName, "rb") as file:
 			covariates = pickle.load(file)
 		start = analysisStart - COVARIATE_FILE_INDEX_OFFSET
@@ -107,20 +105,36 @@ def init(args):
 	vari.setGlobalVariables(args)
 
 
+def getChromoEnds(chromos):
+	with py2bit.open(vari.GENOME) as genome:
+		return {chromo: int(genome.chroms(chromo)) for chromo in chromos}
+
+
+def mergeGroupsByChromo(regions, outputDir, baseName, chromoEnds, covariNum, tempDir):
+	regions = sorted(regions, key=lambda x: x[0])
+
+	mergeGroups = []
+	for chromo, regionGroup in itertools.groupby(regions, lambda x: x[0]):
+		outputFile = outputHDF5File(outputDir, baseName, chromo)
+		mergeGroups.append((chromo, list(regionGroup), outputFile, chromoEnds[chromo], covariNum, tempDir))
+
+	return mergeGroups
+
+
 @timer("Merging Temp Files", 1)
 def mergeTempFiles(outputRegions):
 	flattenedOuputRegions = []
 	for region in outputRegions:
 		flattenedOuputRegions.extend(region)
 
-	# sort by chromosome
-	flattenedOuputRegions.sort(key=lambda x: x[0])
-
-	# group by chromosome
-	mergeGroups = []
-	for chromo, regionGroup in itertools.groupby(flattenedOuputRegions, lambda x: x[0]):
-		outputFile = outputHDF5File(commonVari.OUTPUT_DIR, os.path.basename(commonVari.OUTPUT_DIR), chromo)
-		mergeGroups.append((chromo, list(regionGroup), outputFile))
+	mergeGroups = mergeGroupsByChromo(
+		flattenedOuputRegions,
+		commonVari.OUTPUT_DIR,
+		os.path.basename(commonVari.OUTPUT_DIR),
+		getChromoEnds({chromo for chromo, _, _ in flattenedOuputRegions}),
+		vari.COVARI_NUM,
+		commonVari.OUTPUT_DIR
+	)
 
 	correctedFileNames = utils.process(len(mergeGroups), mergeTempFilesToHDF5, mergeGroups, context="fork")
 
@@ -129,9 +143,17 @@ def mergeTempFiles(outputRegions):
 
 
 @timer("Calculating Covariates", 1)
-def calculateCovariates():
+def calculateCovariates(shardInfo=None):
 	binnedRegions = utils.divideGenome(commonVari.REGIONS)
-	jobGroups = divideWork(binnedRegions, commonVari.REGIONS.cumulativeRegionSize, commonVari.NUMPROCESS)
+
+	if shardInfo is not None:
+		shardIndex, shardCount = shardInfo
+		binnedRegions = shard.shardRegions(binnedRegions, shardIndex, shardCount)
+		print(f"* Shard {shardIndex} of {shardCount}")
+		if len(binnedRegions) == 0:
+			return []
+
+	jobGroups = divideWork(binnedRegions, sum(end - start for _, start, end in binnedRegions), commonVari.NUMPROCESS)
 
 	coefArgs = [(
 		jobGroup,
@@ -142,14 +164,66 @@ def calculateCovariates():
 	return outputRegions
 
 
+@timer("Writing Shard Manifest", 1)
+def writeShardManifest(shardInfo, outputRegions):
+	shardIndex, shardCount = shardInfo
+
+	flattenedOuputRegions = []
+	for region in outputRegions:
+		flattenedOuputRegions.extend([list(x) for x in region])
+
+	manifestFileName = shard.writeManifest(commonVari.OUTPUT_DIR, shardIndex, shardCount, "covariates", {
+		"regions": flattenedOuputRegions,
+		"chromoEnds": getChromoEnds({chromo for chromo, _, _ in flattenedOuputRegions}),
+		"covariNum": vari.COVARI_NUM,
+		"baseName": os.path.basename(commonVari.OUTPUT_DIR),
+	})
+
+	print(f"* Manifest file: {manifestFileName}\n")
+
+
+@timer("MERGING SHARDS")
+def mergeShards(manifests, outputDir, numProcess):
+	""" Merges the temp files written by every shard of a sharded covariates run into the per-chromosome
+	covariate files. _outputDir_ is the directory all the shards wrote to.
+	"""
+	regions = []
+	chromoEnds = {}
+	for manifest in manifests:
+		regions.extend([tuple(x) for x in manifest["regions"]])
+		chromoEnds.update(manifest["chromoEnds"])
+
+	mergeGroups = mergeGroupsByChromo(
+		regions,
+		outputDir,
+		manifests[0]["baseName"],
+		chromoEnds,
+		manifests[0]["covariNum"],
+		outputDir
+	)
+
+	correctedFileNames = utils.process(max(1, min(len(mergeGroups), numProcess)), mergeTempFilesToHDF5, mergeGroups)
+
+	print("* Output file names: ")
+	print(f"{correctedFileNames}\n")
+
+
 def run(args):
 	startTime = time.perf_counter()
 
 	init(args)
 
-	outputRegions = calculateCovariates()
+	try:
+		shardInfo = shard.parseShard(args.shard)
+	except shard.ShardException as e:
+		sys.exit(f"Error: {e}")
+
+	outputRegions = calculateCovariates(shardInfo)
 
-	mergeTempFiles(outputRegions)
+	if shardInfo is not None:
+		writeShardManifest(shardInfo, outputRegions)
+	else:
+		mergeTempFiles(outputRegions)
 
 
 	print(f"-- RUNNING TIME: {((time.perf_counter() - startTime)/3600)} hour(s)")
@@ -3,11 +3,38 @@
 import os
 import h5py
 import numpy as np
-import statsmodels.api as sm
 
 from CRADLE.CorrectBias import vari
+from CRADLE.correctbiasutils import glm
 from CRADLE.correctbiasutils import vari as commonVari
 
+def fitReadCounts(readCounts, X):
+	""" Fits a model for every row of _readCounts_ (samples x positions). Every sample is fit to the same X, so
+	they are fit together, except for the (rare) samples with read counts that don't fit in a float32. Those
+	positions are left out of that sample's fit, so it is fit on its own.
+	"""
+	models = [None] * readCounts.shape[0]
+
+	batchSamples = []
+	for sampleIdx in range(readCounts.shape[0]):
+		sampleReadCounts = readCounts[sampleIdx]
+		deleteIdx = np.where( (sampleReadCounts < np.finfo(np.float32).min) | (sampleReadCounts > np.finfo(np.float32).max))[0]
+		if len(deleteIdx) != 0:
+			# The read counts are truncated to integers, as they were for the statsmodels GLM this replaces
+			models[sampleIdx] = glm.fitPoisson(np.trunc(np.delete(sampleReadCounts, deleteIdx)), np.delete(X, deleteIdx, axis=0))
+		else:
+			batchSamples.append(sampleIdx)
+
+	if len(batchSamples) > 0:
+		for sampleIdx, model in zip(batchSamples, glm.fitPoissonBatch(np.trunc(readCounts[batchSamples]).T, X)):
+			models[sampleIdx] = model
+
+	for model in models:
+		if not model.converged:
+			print(f"Warning! The regression didn't converge after {model.iterations} iterations (deviance: {model.deviance})")
+
+	return models
+
 cpdef performRegression(covariFiles, scatterplotSamples):
 	### Read covariates values (X)
 	xNumRows = 0
@@ -43,16 +70,14 @@ cpdef performRegression(covariFiles, scatterplotSamples):
 	COEFCTRL = np.zeros((commonVari.CTRLBW_NUM, (vari.COVARI_NUM+1)), dtype=np.float64)
 	COEFEXP = np.zeros((commonVari.EXPBW_NUM, (vari.COVARI_NUM+1)), dtype=np.float64)
 
-	readCounts = np.zeros(xNumRows, dtype=np.float64)
-	cdef double [:] readCountsView = readCounts
+	readCounts = np.zeros((commonVari.CTRLBW_NUM + commonVari.EXPBW_NUM, xNumRows), dtype=np.float64)
+	cdef double [:, :] readCountsView = readCounts
 
 	cdef int ptr
 	cdef int rcIdx
+	cdef int rep
 
-	ctrlPlotValues = {}
-	experiPlotValues = {}
-
-	for rep in range(commonVari.CTRLBW_NUM):
+	for rep in range(commonVari.CTRLBW_NUM + commonVari.EXPBW_NUM):
 		ptr = 0
 
 		for fileIdx in range(len(covariFiles)):
@@ -61,7 +86,7 @@ cpdef performRegression(covariFiles, scatterplotSamples):
 
 			rcIdx = 0
 			while rcIdx < f['Y'].shape[0]:
-				readCountsView[rcIdx+ptr] = float(f['Y'][rcIdx])
+				readCountsView[rep, rcIdx+ptr] = float(f['Y'][rcIdx])
 				rcIdx = rcIdx + 1
 
 			ptr = ptr + int(f['Y'].shape[0])
@@ -69,59 +94,26 @@ cpdef performRegression(covariFiles, scatterplotSamples):
 			f.close()
 			os.remove(subfileName)
 
+	# np.asarray(XView) is a view of XView, not a copy
+	models = fitReadCounts(readCounts, np.asarray(XView))
 
-		deleteIdx = np.where( (readCounts < np.finfo(np.float32).min) | (readCounts > np.finfo(np.float32).max))[0]
-		loglink = sm.genmod.families.links.log()
-		poisson = sm.families.Poisson(link=loglink)
-		if len(deleteIdx) != 0:
-			model = sm.GLM(
-				np.delete(readCounts.astype(int), deleteIdx),
-				np.delete(np.array(XView), deleteIdx, axis=0),
-				family=poisson
-			).fit()
-		else:
-			model = sm.GLM(readCounts.astype(int), np.array(XView), family=poisson).fit()
+	ctrlPlotValues = {}
+	experiPlotValues = {}
+
+	for rep in range(commonVari.CTRLBW_NUM):
+		model = models[rep]
 
 		coef = model.params
 		COEFCTRL[rep, ] = coef
 
-		ctrlPlotValues[commonVari.CTRLBW_NAMES[rep]] = (readCounts[scatterplotSamples], model.fittedvalues[scatterplotSamples])
+		ctrlPlotValues[commonVari.CTRLBW_NAMES[rep]] = (readCounts[rep, scatterplotSamples], model.fittedvalues[scatterplotSamples])
 
 	for rep in range(commonVari.EXPBW_NUM):
-		ptr = 0
-		for fileIdx in range(len(covariFiles)):
-			subfileName = covariFiles[fileIdx][rep + 2 + commonVari.CTRLBW_NUM]
-			f = h5py.File(subfileName, "r")
-
-			rcIdx = 0
-			while rcIdx < f['Y'].shape[0]:
-				readCountsView[rcIdx+ptr] = float(f['Y'][rcIdx])
-				rcIdx = rcIdx + 1
-
-			ptr = ptr + int(f['Y'].shape[0])
-
-			f.close()
-			os.remove(subfileName)
-
-		deleteIdx = np.where( (readCounts < np.finfo(np.float32).min) | (readCounts > np.finfo(np.float32).max))[0]
-		loglink = sm.genmod.families.links.log()
-		poisson = sm.families.Poisson(link=loglink)
-		if len(deleteIdx) != 0:
-			model = sm.GLM(
-				np.delete(readCounts.astype(int), deleteIdx),
-				np.delete(np.array(XView), deleteIdx, axis=0),
-				family=poisson
-			).fit()
-		else:
-			model = sm.GLM(
-				readCounts.astype(int),
-				np.array(XView),
-				family=poisson
-			).fit()
+		model = models[rep + commonVari.CTRLBW_NUM]
 
 		coef = model.params
 		COEFEXP[rep, ] = coef
 
-		experiPlotValues[commonVari.EXPBW_NAMES[rep]] = (readCounts[scatterplotSamples], model.fittedvalues[scatterplotSamples])
+		experiPlotValues[commonVari.EXPBW_NAMES[rep]] = (readCounts[rep + commonVari.CTRLBW_NUM, scatterplotSamples], model.fittedvalues[scatterplotSamples])
 
-	return COEFCTRL, COEFEXP, ctrlPlotValues, experiPlotValues
\ No newline at end of file
+	return COEFCTRL, COEFEXP, ctrlPlotValues, experiPlotValues
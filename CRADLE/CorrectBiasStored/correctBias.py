@@ -1,19 +1,23 @@
 import gc
 import math
-import multiprocessing
+import os.path
+import sys
 import time
 
 import numpy as np
 import py2bit # type: ignore
 
 import CRADLE.correctbiasutils as utils
+import CRADLE.correctbiasutils.shard as shard
 import CRADLE.CorrectBiasStored.correctReadCounts as crc
 import CRADLE.CorrectBiasStored.regression as reg # type: ignore
 
 from typing import List, Tuple
 
+from CRADLE.correctbiasutils import ChromoRegion, ChromoRegionSet
 from CRADLE.correctbiasutils import vari as commonVari
 from CRADLE.CorrectBiasStored import vari
+from CRADLE.CorrectBiasStored.model import CorrectionModel
 from CRADLE.logging import timer
 
 
@@ -137,7 +141,8 @@ def selectTrainingSets():
 		RC_PERCENTILE,
 		commonVari.REGIONS,
 		commonVari.CTRLBW_NAMES[0],
-		commonVari.OUTPUT_DIR
+		commonVari.OUTPUT_DIR,
+		vari.TRAINING_SIZE
 	)
 	highRC = rc90Percentile
 
@@ -177,10 +182,16 @@ def calculateScalers(trainSet90Percentile, trainSet90To99Percentile):
 		print("")
 
 
+def regressionSampleGroups(sampleCount, numProcess):
+	""" Splits the samples (by index) into the groups that are fit together, one task per group and training
+	set. Samples fit together share most of the work, so there are just enough groups to keep every process busy.
+	"""
+	groupCount = max(1, min(sampleCount, numProcess // 2))
+	return [group.tolist() for group in np.array_split(np.arange(sampleCount), groupCount)]
+
+
 @timer("Performing Regression", 1)
 def performRegression(covariates, chromoEnds, trainSet90Percentile, trainSet90To99Percentile ):
-	pool = multiprocessing.Pool(2)
-
 	if len(trainSet90Percentile) == 0:
 		trainSet90Percentile = commonVari.REGIONS
 	if len(trainSet90To99Percentile) == 0:
@@ -192,19 +203,41 @@ def performRegression(covariates, chromoEnds, trainSet90Percentile, trainSet90To
 	scatterplotSamples90Percentile = utils.getScatterplotSampleIndices(trainSet90Percentile.cumulativeRegionSize)
 	scatterplotSamples90to99Percentile = utils.getScatterplotSampleIndices(trainSet90To99Percentile.cumulativeRegionSize)
 
-	coefResult = pool.starmap_async(
-		reg.performRegression,
-		[
-			[
-				trainSet90Percentile, covariates, commonVari.CTRLBW_NAMES, commonVari.CTRLSCALER, commonVari.EXPBW_NAMES, commonVari.EXPSCALER, scatterplotSamples90Percentile
-			],
-			[
-				trainSet90To99Percentile, covariates, commonVari.CTRLBW_NAMES, commonVari.CTRLSCALER, commonVari.EXPBW_NAMES, commonVari.EXPSCALER, scatterplotSamples90to99Percentile
-			]
-		]
-	).get()
-	pool.close()
-	pool.join()
+	bwFileNames = commonVari.CTRLBW_NAMES + commonVari.EXPBW_NAMES
+	scalers = list(commonVari.CTRLSCALER) + list(commonVari.EXPSCALER)
+	sampleGroups = regressionSampleGroups(len(bwFileNames), commonVari.NUMPROCESS)
+
+	# Every (training set, sample group) fit is a separate task. The design matrix of each training set is
+	# built once, in shared memory, and used by all of its tasks.
+	sharedXs = []
+	try:
+		tasks = []
+		for trainingSet, scatterplotSamples in [
+			(trainSet90Percentile, scatterplotSamples90Percentile),
+			(trainSet90To99Percentile, scatterplotSamples90to99Percentile)
+		]:
+			sharedX = reg.sharedCovariateMatrix(trainingSet, covariates)
+			sharedXs.append(sharedX)
+			sharedXDescriptor = None if sharedX is None else sharedX.descriptor
+
+			for group in sampleGroups:
+				tasks.append([
+					trainingSet, covariates, sharedXDescriptor,
+					[bwFileNames[i] for i in group], [scalers[i] for i in group], scatterplotSamples
+				])
+
+		taskResults = utils.process(min(commonVari.NUMPROCESS, len(tasks)), reg.fitSamplesTask, tasks)
+	finally:
+		for sharedX in sharedXs:
+			if sharedX is not None:
+				sharedX.close()
+
+	coefResult = []
+	for trainingSetIdx in range(2):
+		sampleResults = []
+		for groupResults in taskResults[trainingSetIdx * len(sampleGroups):(trainingSetIdx + 1) * len(sampleGroups)]:
+			sampleResults.extend(groupResults)
+		coefResult.append(reg.collectResults(sampleResults, commonVari.CTRLBW_NAMES, commonVari.EXPBW_NAMES))
 
 	for name in commonVari.CTRLBW_NAMES:
 		fileName = utils.figureFileName(commonVari.OUTPUT_DIR, name)
@@ -264,21 +297,22 @@ def normalizeReadCounts(covariates, chromoEnds, trainSet90Percentile, trainSet90
 
 @timer("Correcting Read Counts", 1)
 def correctReads(crcArgs):
-	utils.process(min(len(crcArgs), commonVari.NUMPROCESS), crc.correctReadCount, crcArgs)
+	metrics = utils.process(min(len(crcArgs), commonVari.NUMPROCESS), crc.correctReadCount, crcArgs)
+
+	readTime = sum(workerMetrics["readTime"] for workerMetrics in metrics)
+	stallTime = sum(workerMetrics["stallTime"] for workerMetrics in metrics)
+	print(f"* Reading read counts and covariates: {readTime} sec(s), waited on: {stallTime} sec(s) (prefetch depth {vari.PREFETCH_DEPTH})")
 
 
 @timer("Merging Temp Files", 1)
 def mergeTempFiles(resultBWHeader, jobGroups):
-	fileChromoInfo = []
-	for jobGroup in jobGroups:
-		fileChromoInfo.extend([(chromo, chromoId) for chromo, chromoId, _ in jobGroup])
-
 	correctedFileNames = utils.mergeBWFiles(
 		commonVari.OUTPUT_DIR,
 		resultBWHeader,
-		fileChromoInfo,
+		fileChromoInfoFromJobGroups(jobGroups),
 		commonVari.CTRLBW_NAMES,
-		commonVari.EXPBW_NAMES
+		commonVari.EXPBW_NAMES,
+		vari.OUTPUT_FORMAT
 	)
 
 	print("* Output file names: ")
@@ -286,18 +320,34 @@ def mergeTempFiles(resultBWHeader, jobGroups):
 
 
 @timer("FITTING ALL THE ANALYSIS REGIONS TO THE CORRECTION MODEL")
-def correctReadCounts(covariates, chromoEnds, coefCtrl, coefExp, coefCtrlHighrc, coefExpHighrc, highRC):
+def correctReadCounts(covariates, chromoEnds, model):
 	binnedRegions = utils.divideGenome(commonVari.REGIONS)
 
-	jobGroups = divideWork(binnedRegions, commonVari.REGIONS.cumulativeRegionSize, commonVari.NUMPROCESS)
-	jobGroups = divideWorkByChrom(jobGroups)
+	if vari.SHARD is not None:
+		shardIndex, shardCount = vari.SHARD
+		binnedRegions = shard.shardRegions(binnedRegions, shardIndex, shardCount)
+		print(f"* Shard {shardIndex} of {shardCount}")
+
 	print(f"* {len(binnedRegions)} regions")
+	if len(binnedRegions) == 0:
+		return []
+
+	jobGroups = divideWork(binnedRegions, sum(end - start for _, start, end in binnedRegions), commonVari.NUMPROCESS)
+	jobGroups = divideWorkByChrom(jobGroups)
+
+	if vari.SHARD is not None:
+		# Prefix the chromosome ids with the shard index so temp file names are unique across shards and
+		# still sort in genome order when merged
+		jobGroups = [
+			[(chromo, f"{shardIndex}_{chromoId}", regions) for chromo, chromoId, regions in jobGroup]
+			for jobGroup in jobGroups
+		]
 
 	trainingBWName = commonVari.CTRLBW_NAMES[0]
 	bwNames = commonVari.CTRLBW_NAMES + commonVari.EXPBW_NAMES
 	scalers = commonVari.CTRLSCALER  + commonVari.EXPSCALER
-	coefs = np.concatenate((coefCtrl, coefExp), axis=0)
-	coefHighrcs =  np.concatenate((coefCtrlHighrc, coefExpHighrc), axis=0)
+	coefs = np.concatenate((model.coefCtrl, model.coefExp), axis=0)
+	coefHighrcs =  np.concatenate((model.coefCtrlHighrc, model.coefExpHighrc), axis=0)
 
 	crcArgs = [(
 		jobGroup,
@@ -308,10 +358,12 @@ def correctReadCounts(covariates, chromoEnds, coefCtrl, coefExp, coefCtrlHighrc,
 		scalers,
 		coefs,
 		coefHighrcs,
-		highRC,
+		model.highRC,
 		vari.MIN_FRAG_FILTER_VALUE,
 		vari.BINSIZE,
-		commonVari.OUTPUT_DIR
+		commonVari.OUTPUT_DIR,
+		vari.OUTPUT_FORMAT,
+		vari.PREFETCH_DEPTH
 	) for jobGroup in jobGroups]
 
 	correctReads(crcArgs)
@@ -335,11 +387,7 @@ def normalizeBigWigs(resultBWHeader):
 	print(f"{normObFileNames}\n")
 
 
-def run(args):
-	startTime = time.perf_counter()
-
-	covariates, chromoEnds, resultBWHeader = init(args)
-
+def trainModel(covariates, chromoEnds):
 	trainSet90Percentile, trainSet90To99Percentile, highRC = selectTrainingSets()
 
 	coefCtrl, coefExp, coefCtrlHighrc, coefExpHighrc = normalizeReadCounts(
@@ -349,11 +397,150 @@ def run(args):
 		trainSet90To99Percentile
 	)
 
-	jobGroups = correctReadCounts(covariates, chromoEnds, coefCtrl, coefExp, coefCtrlHighrc, coefExpHighrc, highRC)
+	return CorrectionModel(
+		commonVari.CTRLBW_NAMES,
+		commonVari.EXPBW_NAMES,
+		commonVari.CTRLSCALER,
+		commonVari.EXPSCALER,
+		coefCtrl,
+		coefExp,
+		coefCtrlHighrc,
+		coefExpHighrc,
+		highRC,
+		covariates.order
+	)
+
+
+@timer("LOADING THE CORRECTION MODEL")
+def loadModel(covariates):
+	model = CorrectionModel.load(vari.MODEL_FILE)
+
+	error = model.checkCompatibility(commonVari.CTRLBW_NAMES, commonVari.EXPBW_NAMES, covariates.order)
+	if error is not None:
+		print(f"Error! {error}: {vari.MODEL_FILE}")
+		sys.exit()
+
+	# Sets vari.CTRLSCALER and vari.EXPSCALER
+	commonVari.setScaler(model.ctrlScaler[1:] + model.expScaler)
+
+	print(f"* Model file: {vari.MODEL_FILE}")
+	print(f"* CTRLBW: {commonVari.CTRLSCALER}")
+	print(f"* EXPBW: {commonVari.EXPSCALER}")
+	print("")
+
+	return model
 
-	mergeTempFiles(resultBWHeader, jobGroups)
 
-	if vari.I_GENERATE_NORM_BW:
-		normalizeBigWigs(resultBWHeader)
+def getModel(covariates, chromoEnds):
+	""" Trains the correction model or, if a model file is given, loads it. If the model file doesn't exist yet
+	exactly one run (e.g., one of several shards) trains and saves the model while the others wait for it.
+	"""
+	if vari.MODEL_FILE is None:
+		return trainModel(covariates, chromoEnds)
+
+	lockFileName = vari.MODEL_FILE + ".lock"
+	if not os.path.exists(vari.MODEL_FILE):
+		if shard.acquireLock(lockFileName):
+			try:
+				# Another run may have saved the model between the existence check and acquiring the lock
+				if not os.path.exists(vari.MODEL_FILE):
+					model = trainModel(covariates, chromoEnds)
+					model.save(vari.MODEL_FILE)
+					print(f"* Saved model file: {vari.MODEL_FILE}\n")
+					return model
+			finally:
+				shard.releaseLock(lockFileName)
+		else:
+			print(f"* Waiting for another run to train the model: {vari.MODEL_FILE}\n")
+			shard.waitForFile(vari.MODEL_FILE, lockFileName)
+
+	return loadModel(covariates)
+
+
+def fileChromoInfoFromJobGroups(jobGroups):
+	fileChromoInfo = []
+	for jobGroup in jobGroups:
+		fileChromoInfo.extend([(chromo, chromoId) for chromo, chromoId, _ in jobGroup])
+
+	return fileChromoInfo
+
+
+@timer("WRITING SHARD MANIFEST")
+def writeShardManifest(resultBWHeader, jobGroups):
+	shardIndex, shardCount = vari.SHARD
+
+	# The normalized observed bigwigs aren't split by region, so they are generated once, by merge,
+	# using the information recorded by the first shard.
+	normalizedBW = None
+	if vari.I_GENERATE_NORM_BW and shardIndex == 1:
+		normalizedBW = {
+			"regions": [[region.chromo, region.start, region.end] for region in commonVari.REGIONS],
+			"ctrlScaler": commonVari.CTRLSCALER,
+			"expScaler": commonVari.EXPSCALER,
+		}
+
+	manifestFileName = shard.writeManifest(commonVari.OUTPUT_DIR, shardIndex, shardCount, "correctBias_stored", {
+		"header": resultBWHeader,
+		"fileChromoInfo": fileChromoInfoFromJobGroups(jobGroups),
+		"ctrlbw": commonVari.CTRLBW_NAMES,
+		"expbw": commonVari.EXPBW_NAMES,
+		"outputFormat": vari.OUTPUT_FORMAT,
+		"normalizedBW": normalizedBW,
+	})
+
+	print(f"* Manifest file: {manifestFileName}\n")
+
+
+@timer("MERGING SHARDS")
+def mergeShards(manifests, outputDir):
+	""" Merges the temp files written by every shard of a sharded correctBias_stored run into the final
+	corrected bigwigs. _outputDir_ is the directory all the shards wrote to.
+	"""
+	resultBWHeader = [(chromo, chromoLen) for chromo, chromoLen in manifests[0]["header"]]
+	ctrlBWNames = manifests[0]["ctrlbw"]
+	expBWNames = manifests[0]["expbw"]
+
+	fileChromoInfo = []
+	for manifest in manifests:
+		fileChromoInfo.extend([(chromo, chromoId) for chromo, chromoId in manifest["fileChromoInfo"]])
+
+	correctedFileNames = utils.mergeBWFiles(outputDir, resultBWHeader, fileChromoInfo, ctrlBWNames, expBWNames, manifests[0]["outputFormat"])
+
+	print("* Output file names: ")
+	print(f"{correctedFileNames}\n")
+
+	normalizedBW = manifests[0]["normalizedBW"]
+	if normalizedBW is not None:
+		regions = ChromoRegionSet([ChromoRegion(chromo, start, end) for chromo, start, end in normalizedBW["regions"]])
+		normObFileNames = utils.genNormalizedObBWs(
+			outputDir,
+			resultBWHeader,
+			regions,
+			ctrlBWNames,
+			normalizedBW["ctrlScaler"],
+			expBWNames,
+			normalizedBW["expScaler"]
+		)
+
+		print("* Nomralized observed bigwig file names: ")
+		print(f"{normObFileNames}\n")
+
+
+def run(args):
+	startTime = time.perf_counter()
+
+	covariates, chromoEnds, resultBWHeader = init(args)
+
+	model = getModel(covariates, chromoEnds)
+
+	jobGroups = correctReadCounts(covariates, chromoEnds, model)
+
+	if vari.SHARD is not None:
+		writeShardManifest(resultBWHeader, jobGroups)
+	else:
+		mergeTempFiles(resultBWHeader, jobGroups)
+
+		if vari.I_GENERATE_NORM_BW:
+			normalizeBigWigs(resultBWHeader)
 
 	print(f"-- TOTAL RUNNING TIME: {((time.perf_counter() - startTime) / 3600)} hour(s)")
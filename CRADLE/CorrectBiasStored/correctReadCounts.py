@@ -1,11 +1,10 @@
-import struct
-
-import h5py # type: ignore
 import numpy as np
 import pyBigWig # type: ignore
 
-from CRADLE.correctbiasutils import CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT, SONICATION_SHEAR_BIAS_OFFSET, START_INDEX_ADJUSTMENT, outputCorrectedTmpFile
+from CRADLE.correctbiasutils import SONICATION_SHEAR_BIAS_OFFSET, START_INDEX_ADJUSTMENT
 from CRADLE.correctbiasutils.cython import coalesceSections # type: ignore
+from CRADLE.correctbiasutils.outputSinks import openCorrectedReadsWriter
+from CRADLE.correctbiasutils.prefetch import Prefetcher
 
 # The covariate values stored in the HDF files start at index 0 (0-index, obviously)
 # The lowest start point for an analysis region is 3 (1-indexed), so we need to subtract
@@ -13,6 +12,9 @@ from CRADLE.correctbiasutils.cython import coalesceSections # type: ignore
 # in the HDF files.
 COVARIATE_FILE_INDEX_OFFSET = 3
 
+# The number of positions whose predicted read counts are calculated at a time
+PREDICTION_BLOCK_SIZE = 16_384
+
 def alignCoordinatesToCovariateFileBoundaries(region, chromoEnds, fragLen):
 	chromo, analysisStart, analysisEnd = region
 	chromoEnd = chromoEnds[chromo]
@@ -37,19 +39,72 @@ def alignCoordinatesToCovariateFileBoundaries(region, chromoEnds, fragLen):
 
 	return (analysisStart, analysisEnd)
 
-def writeCorrectedReads(outFile, sectionCount, starts, ends, values):
-	for i in range(sectionCount):
-		outFile.write(struct.pack(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT, starts[i], ends[i], values[i]))
-
-def correctReadCount(regions, chromoEnds, covariates, trainingBWName, bwNames, scalers, COEFs, COEF_HIGHRCs, highRC, minFragFilterValue, binsize, outputDir):
+def readRegionData(bwFiles, covariateValues, chromo, analysisStart, analysisEnd):
+	readCounts = []
+	for bwFile in bwFiles:
+		if pyBigWig.numpy == 1:
+			rcArr = bwFile.values(chromo, analysisStart, analysisEnd, numpy=True).astype(np.float64)
+		else:
+			rcArr = np.array(bwFile.values(chromo, analysisStart, analysisEnd))
+		rcArr[np.isnan(rcArr)] = 0.0
+		readCounts.append(rcArr)
+
+	values = covariateValues[(analysisStart - COVARIATE_FILE_INDEX_OFFSET):(analysisEnd - COVARIATE_FILE_INDEX_OFFSET)]
+
+	return readCounts, values
+
+def coefMatrices(COEFs):
+	""" Splits the coefficients (samples × (intercept + covariates)) into intercepts and a (covariates × samples)
+	matrix. The coefficients of covariates that weren't selected are NaN, they are zeroed here so they drop out of
+	the matrix product (just like np.nansum ignored them).
+	"""
+	COEFs = np.asarray(COEFs, dtype=np.float64)
+	intercepts = COEFs[:, 0]
+	coefMatrix = COEFs[:, 1:].T.copy()
+	coefMatrix[np.isnan(coefMatrix)] = 0.0
+
+	return intercepts, coefMatrix
+
+def predictReadCounts(covariateMatrix, highReadCountMask, intercepts, coefMatrix, highRCIntercepts, highRCCoefMatrix):
+	""" Predicts the read counts of every sample at once as a (positions × samples) matrix. Positions in
+	_highReadCountMask_ use the high read count model. The work is done in blocks of PREDICTION_BLOCK_SIZE
+	positions to bound the size of the temporaries.
+	"""
+	positionCount = covariateMatrix.shape[0]
+	prdvals = np.empty((positionCount, coefMatrix.shape[1]), dtype=np.float64)
+
+	for blockStart in range(0, positionCount, PREDICTION_BLOCK_SIZE):
+		blockEnd = min(blockStart + PREDICTION_BLOCK_SIZE, positionCount)
+		blockCovariates = covariateMatrix[blockStart:blockEnd]
+		blockPrdvals = prdvals[blockStart:blockEnd]
+
+		np.matmul(blockCovariates, coefMatrix, out=blockPrdvals)
+		blockPrdvals += intercepts
+
+		blockHighReadCountMask = highReadCountMask[blockStart:blockEnd]
+		if blockHighReadCountMask.any():
+			blockPrdvals[blockHighReadCountMask] = blockCovariates[blockHighReadCountMask] @ highRCCoefMatrix + highRCIntercepts
+
+		np.exp(blockPrdvals, out=blockPrdvals)
+
+	return prdvals
+
+def correctReadCount(regions, chromoEnds, covariates, trainingBWName, bwNames, scalers, COEFs, COEF_HIGHRCs, highRC, minFragFilterValue, binsize, outputDir, outputFormat, prefetchDepth):
+	""" Corrects the read counts of every sample in _regions_. Returns the time spent reading the read counts and
+	covariate values ("readTime") and how much of it the correction had to wait for ("stallTime").
+	"""
+	metrics = {"readTime": 0.0, "stallTime": 0.0}
 	meanMinFragFilterValue = int(np.round(minFragFilterValue / len(bwNames)))
 	bwFiles = [pyBigWig.open(bwName) for bwName in bwNames]
 	trainingFile = pyBigWig.open(trainingBWName)
 
+	intercepts, coefMatrix = coefMatrices(COEFs)
+	highRCIntercepts, highRCCoefMatrix = coefMatrices(COEF_HIGHRCs)
+
 	for chromoRegionData in regions:
 		chromo, chromoId, chromoRegions = chromoRegionData
-		covariateFile = h5py.File(covariates.covariateFileName(chromo), "r")
-		covariateValues = covariateFile['covari']
+		covariateFile = covariates.open(chromo)
+		covariateValues = covariateFile.values
 
 		# Align regions to the covariate file boundaries, generate the "overall" indices used later and load up the training read counts
 		# all in one loop
@@ -74,56 +129,59 @@ def correctReadCount(regions, chromoEnds, covariates, trainingBWName, bwNames, s
 		trainingReadCounts[np.isnan(trainingReadCounts)] = 0.0
 
 		del chromoRegions # We don't need this anymore and should break if we use it
-		
+
 		if len(overallIndices) == 0:
 			continue
 
-		for bwName, bwFile, scaler, COEF, COEF_HIGHRC in zip(bwNames, bwFiles, scalers, COEFs, COEF_HIGHRCs):
-			correctedReadCountOutputFile = open(outputCorrectedTmpFile(outputDir, chromo, chromoId, bwName), "wb")
+		correctedReadCountWriters = [openCorrectedReadsWriter(outputFormat, outputDir, chromo, chromoId, bwName) for bwName in bwNames]
 
-			for region, overallIdx in zip(adjustedChromoRegions, overallIndices):
-				analysisStart, analysisEnd = region
+		# Read counts and covariate values are read on a background thread while the previous region is corrected
+		regionData = Prefetcher(
+			readRegionData,
+			[(bwFiles, covariateValues, chromo, analysisStart, analysisEnd) for analysisStart, analysisEnd in adjustedChromoRegions],
+			prefetchDepth
+		)
 
-				###### GET POSITIONS WHERE THE NUMBER OF FRAGMENTS > MIN_FRAGNUM_FILTER_VALUE
-				if pyBigWig.numpy == 1:
-					rcArr = bwFile.values(chromo, analysisStart, analysisEnd, numpy=True).astype(np.float64)
-				else:
-					rcArr = np.array(bwFile.values(chromo, analysisStart, analysisEnd))
-				rcArr[np.isnan(rcArr)] = 0.0
+		for (analysisStart, analysisEnd), overallIdx, (readCounts, values) in zip(adjustedChromoRegions, overallIndices, regionData):
+			# The covariate matrix is the same for every sample, so unselected and missing (NaN) covariates are zeroed once
+			covariateMatrix = values * covariates.selected
+			covariateMatrix[np.isnan(covariateMatrix)] = 0.0
 
-				rcArr = rcArr / scaler
+			highReadCountIdx = selectHighRCIdx(trainingReadCounts[analysisStart:analysisEnd], overallIdx, highRC)
+			highReadCountMask = np.zeros(analysisEnd - analysisStart, dtype=bool)
+			highReadCountMask[highReadCountIdx] = True
 
-				## OUTPUT FILES
-				values = covariateValues[(analysisStart - COVARIATE_FILE_INDEX_OFFSET):(analysisEnd - COVARIATE_FILE_INDEX_OFFSET)]
-				values = values * covariates.selected
-				prdvals = np.exp(
-					np.nansum(values * COEF[1:], axis=1) + COEF[0]
-				)
+			prdvals = predictReadCounts(covariateMatrix, highReadCountMask, intercepts, coefMatrix, highRCIntercepts, highRCCoefMatrix)
+			starts = np.arange(analysisStart, analysisEnd)[overallIdx]
 
-				highReadCountIdx = selectHighRCIdx(trainingReadCounts[analysisStart:analysisEnd], overallIdx, highRC)
-				prdvals[highReadCountIdx] = np.exp(
-					np.nansum(values[highReadCountIdx] * COEF_HIGHRC[1:], axis=1) + COEF_HIGHRC[0]
-				)
+			for sampleIdx, (rcArr, scaler, correctedReadCountWriter) in enumerate(zip(readCounts, scalers, correctedReadCountWriters)):
+				rcArr = rcArr / scaler
 
-				rcArr = rcArr - prdvals
+				rcArr = rcArr - prdvals[:, sampleIdx]
 				rcArr = rcArr[overallIdx]
-				starts = np.arange(analysisStart, analysisEnd)[overallIdx]
 
 				outOfRangeIdx = np.where((rcArr < np.finfo(np.float32).min) | (rcArr > np.finfo(np.float32).max))
-				starts = np.delete(starts, outOfRangeIdx)
+				sampleStarts = np.delete(starts, outOfRangeIdx)
 				rcArr = np.delete(rcArr, outOfRangeIdx)
 
 				if len(rcArr) > 0:
 					rcArr = np.rint(rcArr)
-					coalescedSectionCount, startEntries, endEntries, valueEntries = coalesceSections(starts, rcArr, analysisEnd, binsize)
-					writeCorrectedReads(correctedReadCountOutputFile, coalescedSectionCount, startEntries, endEntries, valueEntries)
-			correctedReadCountOutputFile.close()
+					coalescedSectionCount, startEntries, endEntries, valueEntries = coalesceSections(sampleStarts, rcArr, analysisEnd, binsize)
+					correctedReadCountWriter.write(coalescedSectionCount, startEntries, endEntries, valueEntries)
+
+		for correctedReadCountWriter in correctedReadCountWriters:
+			correctedReadCountWriter.close()
+
+		metrics["readTime"] += regionData.loadTime
+		metrics["stallTime"] += regionData.stallTime
 		covariateFile.close()
 
 	for file in bwFiles:
 		file.close()
 	trainingFile.close()
 
+	return metrics
+
 
 def selectOverallIdx(chromo, analysisStart, analysisEnd, bwFiles, minFragFilterValue, meanMinFragFilterValue):
 	readCountSums = np.zeros(analysisEnd - analysisStart, dtype=np.float32)
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+
+class CorrectionModel:
+	"""The result of training: normalizing constants and regression coefficients for every sample. Saving it
+	lets several correctBias_stored runs (e.g., shards of a whole-genome run) share one trained model."""
+	__slots__ = ["ctrlBWNames", "expBWNames", "ctrlScaler", "expScaler", "coefCtrl", "coefExp", "coefCtrlHighrc", "coefExpHighrc", "highRC", "covariateOrder"]
+
+	def __init__(self, ctrlBWNames, expBWNames, ctrlScaler, expScaler, coefCtrl, coefExp, coefCtrlHighrc, coefExpHighrc, highRC, covariateOrder):
+		self.ctrlBWNames = list(ctrlBWNames)
+		self.expBWNames = list(expBWNames)
+		self.ctrlScaler = [float(x) for x in ctrlScaler]
+		self.expScaler = [float(x) for x in expScaler]
+		self.coefCtrl = np.asarray(coefCtrl, dtype=np.float64)
+		self.coefExp = np.asarray(coefExp, dtype=np.float64)
+		self.coefCtrlHighrc = np.asarray(coefCtrlHighrc, dtype=np.float64)
+		self.coefExpHighrc = np.asarray(coefExpHighrc, dtype=np.float64)
+		self.highRC = highRC
+		self.covariateOrder = list(covariateOrder)
+
+	def save(self, fileName):
+		# Write to a temp file and rename it so other processes never load a partially written model
+		tempFileName = f"{fileName}.{os.getpid()}.tmp"
+		with open(tempFileName, "wb") as modelFile:
+			np.savez(
+				modelFile,
+				ctrlBWNames=np.array(self.ctrlBWNames),
+				expBWNames=np.array(self.expBWNames),
+				ctrlScaler=np.array(self.ctrlScaler),
+				expScaler=np.array(self.expScaler),
+				coefCtrl=self.coefCtrl,
+				coefExp=self.coefExp,
+				coefCtrlHighrc=self.coefCtrlHighrc,
+				coefExpHighrc=self.coefExpHighrc,
+				highRC=np.array(self.highRC),
+				covariateOrder=np.array(self.covariateOrder),
+			)
+		os.replace(tempFileName, fileName)
+
+	@classmethod
+	def load(cls, fileName):
+		with np.load(fileName) as data:
+			return cls(
+				data["ctrlBWNames"].tolist(),
+				data["expBWNames"].tolist(),
+				data["ctrlScaler"].tolist(),
+				data["expScaler"].tolist(),
+				data["coefCtrl"],
+				data["coefExp"],
+				data["coefCtrlHighrc"],
+				data["coefExpHighrc"],
+				data["highRC"].item(),
+				data["covariateOrder"].tolist(),
+			)
+
+	def checkCompatibility(self, ctrlBWNames, expBWNames, covariateOrder):
+		if self.ctrlBWNames != list(ctrlBWNames) or self.expBWNames != list(expBWNames):
+			return "The model was trained with different -ctrlbw/-expbw files"
+		if self.covariateOrder != list(covariateOrder):
+			return "The model was trained with a different -biasType"
+		return None
@@ -1,34 +1,182 @@
-import h5py
 import numpy as np
-import statsmodels.api as sm
 import pyBigWig
 
+from CRADLE.correctbiasutils import ChromoRegion, ChromoRegionSet, glm
+from CRADLE.correctbiasutils.sharedArray import SharedArray
+
 COEF_LEN = 7
 
+# Training sets with more positions than this are fit out of core: the covariates and read counts are
+# streamed in blocks of STREAMED_REGRESSION_BLOCK_SIZE positions in every iteration instead of being held in memory.
+IN_MEMORY_REGRESSION_MAX_SIZE = 4_000_000
+STREAMED_REGRESSION_BLOCK_SIZE = 1_000_000
+
 # The covariate values stored in the HDF files start at index 0 (0-index, obviously)
 # The lowest start point for an analysis region is 3 (1-indexed), so we need to subtract
 # 3 from the analysis start and end points to match them up with correct covariate values
 # in the HDF files.
 COVARIATE_FILE_INDEX_OFFSET = 3
 
-def performRegression(trainingSet, covariates, ctrlBWNames, ctrlScaler, experiBWNames, experiScaler, scatterplotSamples):
+def groupRegionsForReading(regions, maxGap):
+	""" Groups (start, end, row) regions, sorted by start, into runs that can be read with a single slice.
+	Regions closer than _maxGap_ are read together since the rows between them would be read
+	(e.g., decompressed as part of the same chunk) anyway.
+	"""
+	runs = []
+	for region in regions:
+		start, end, _ = region
+		if len(runs) > 0 and start - runs[-1][1] < maxGap:
+			runs[-1][1] = max(runs[-1][1], end)
+			runs[-1][2].append(region)
+		else:
+			runs.append([start, end, [region]])
+
+	return runs
+
+def getCovariateMatrix(trainingSet, covariates, out=None):
+	""" Builds the design matrix, an intercept column followed by the selected covariates, with one row per
+	position of _trainingSet_ (in trainingSet order). Each chromosome's covariate file is opened once and its
+	regions are read in position order, with nearby regions read together.
+
+	The matrix is written to _out_, if given.
+	"""
 	xColumnCount = covariates.num + 1
+	selectedColumns = np.where(~np.isnan(covariates.selected))[0]
 
-	#### Get X matrix
-	xView = np.ones((trainingSet.cumulativeRegionSize, xColumnCount), dtype=np.float64)
+	if out is None:
+		xView = np.ones((trainingSet.cumulativeRegionSize, xColumnCount), dtype=np.float64)
+	else:
+		xView = out
+		xView[:, 0] = 1.0
 
+	chromoRegions = {}
 	currentRow = 0
-
 	for trainingRegion in trainingSet:
-		covariateFileName = covariates.covariateFileName(trainingRegion.chromo)
-		with h5py.File(covariateFileName, "r") as covariateValues:
-			nonSelectedRows = np.where(np.isnan(covariates.selected))
-			temp = covariateValues['covari'][trainingRegion.start - COVARIATE_FILE_INDEX_OFFSET:trainingRegion.end - COVARIATE_FILE_INDEX_OFFSET]
-			temp = np.delete(temp, nonSelectedRows, 1)
-			xView[currentRow:currentRow + len(trainingRegion), 1:xColumnCount] = temp
-			currentRow += len(trainingRegion)
-	#### END Get X matrix
+		chromoRegions.setdefault(trainingRegion.chromo, []).append((trainingRegion.start, trainingRegion.end, currentRow))
+		currentRow += len(trainingRegion)
+
+	for chromo, regions in chromoRegions.items():
+		regions.sort()
+		with covariates.open(chromo) as covariateFile:
+			for runStart, runEnd, runRegions in groupRegionsForReading(regions, covariateFile.chunkRows):
+				runValues = covariateFile.values[runStart - COVARIATE_FILE_INDEX_OFFSET:runEnd - COVARIATE_FILE_INDEX_OFFSET]
+				runValues = runValues[:, selectedColumns]
+				for start, end, row in runRegions:
+					xView[row:row + (end - start), 1:xColumnCount] = runValues[start - runStart:end - runStart]
+
+	return xView
+
+def splitTrainingSet(trainingSet, blockSize):
+	""" Splits _trainingSet_, in order, into ChromoRegionSets of at most _blockSize_ positions. Regions are
+	split across blocks when needed, so the rows of the blocks, one after another, are the rows of the
+	whole training set.
+	"""
+	blocks = []
+	blockRegions = []
+	blockRegionSize = 0
+	for region in trainingSet:
+		start = region.start
+		while start < region.end:
+			end = min(region.end, start + blockSize - blockRegionSize)
+			blockRegions.append(ChromoRegion(region.chromo, start, end))
+			blockRegionSize += end - start
+			start = end
+
+			if blockRegionSize == blockSize:
+				blocks.append(ChromoRegionSet(blockRegions))
+				blockRegions = []
+				blockRegionSize = 0
+
+	if len(blockRegions) > 0:
+		blocks.append(ChromoRegionSet(blockRegions))
+
+	return blocks
+
+def getReadCountMatrix(trainingSet, bwFileNames, scalers):
+	"""The scaled read counts of _trainingSet_, one column per sample"""
+	readCounts = np.empty((trainingSet.cumulativeRegionSize, len(bwFileNames)), dtype=np.float64)
+	for i, (bwFileName, scaler) in enumerate(zip(bwFileNames, scalers)):
+		rawReadCounts = readCountData(bwFileName, trainingSet)
+		readCounts[:, i] = getReadCounts(rawReadCounts, trainingSet.cumulativeRegionSize, scaler)
+
+	return readCounts
+
+def buildStreamedModels(trainingSet, covariates, bwFileNames, scalers, scatterplotSamples):
+	""" Fits the models without holding the whole training set in memory. Returns the models, whose
+	fittedvalues are only those of the scatterplotSamples rows, and the read counts of those rows.
+	"""
+	trainingBlocks = splitTrainingSet(trainingSet, STREAMED_REGRESSION_BLOCK_SIZE)
+	plotReadCounts = np.zeros((len(scatterplotSamples), len(bwFileNames)), dtype=np.float64)
+
+	def readBlocks(includeX):
+		blockStart = 0
+		for block in trainingBlocks:
+			readCounts = getReadCountMatrix(block, bwFileNames, scalers)
 
+			blockEnd = blockStart + block.cumulativeRegionSize
+			plotRows = np.where((scatterplotSamples >= blockStart) & (scatterplotSamples < blockEnd))[0]
+			plotReadCounts[plotRows] = readCounts[scatterplotSamples[plotRows] - blockStart]
+			blockStart = blockEnd
+
+			# The read counts are truncated to integers, as they were for the statsmodels GLM this replaces
+			yield np.trunc(readCounts), (getCovariateMatrix(block, covariates) if includeX else None)
+
+	models = glm.fitPoissonStreamed(readBlocks, len(bwFileNames), fittedRows=scatterplotSamples)
+	warnUnconverged(models)
+
+	return models, plotReadCounts
+
+def sharedCovariateMatrix(trainingSet, covariates):
+	""" getCovariateMatrix, built in shared memory so every regression task can use it without a copy. None
+	when the training set is too large and is fit out of core.
+	"""
+	if trainingSet.cumulativeRegionSize > IN_MEMORY_REGRESSION_MAX_SIZE:
+		return None
+
+	sharedX = SharedArray.create((trainingSet.cumulativeRegionSize, covariates.num + 1), np.float64)
+	try:
+		getCovariateMatrix(trainingSet, covariates, out=sharedX.array)
+	except Exception:
+		sharedX.close()
+		raise
+
+	return sharedX
+
+def fitSamples(trainingSet, covariates, xView, bwFileNames, scalers, scatterplotSamples):
+	""" Fits the models of the _bwFileNames_ samples, together, on _trainingSet_, using the design matrix
+	_xView_, or streaming it if _xView_ is None. Returns each sample's coefficients and scatterplot values.
+	"""
+	scatterplotSamples = np.asarray(scatterplotSamples)
+
+	if xView is None:
+		models, plotReadCounts = buildStreamedModels(trainingSet, covariates, bwFileNames, scalers, scatterplotSamples)
+		plotFittedValues = [model.fittedvalues for model in models]
+	else:
+		readCounts = getReadCountMatrix(trainingSet, bwFileNames, scalers)
+		models = buildModels(readCounts, xView)
+		plotReadCounts = readCounts[scatterplotSamples]
+		plotFittedValues = [model.fittedvalues[scatterplotSamples] for model in models]
+
+	return [
+		(getCoefs(model.params, covariates.selected), (plotReadCounts[:, i], plotFittedValues[i]))
+		for i, model in enumerate(models)
+	]
+
+def fitSamplesTask(trainingSet, covariates, sharedXDescriptor, bwFileNames, scalers, scatterplotSamples):
+	"""fitSamples, in a worker process, using the shared design matrix described by _sharedXDescriptor_"""
+	if sharedXDescriptor is None:
+		return fitSamples(trainingSet, covariates, None, bwFileNames, scalers, scatterplotSamples)
+
+	sharedX = SharedArray.attach(sharedXDescriptor)
+	try:
+		return fitSamples(trainingSet, covariates, sharedX.array, bwFileNames, scalers, scatterplotSamples)
+	finally:
+		sharedX.close()
+
+def collectResults(sampleResults, ctrlBWNames, experiBWNames):
+	""" Arranges the fitSamples results of all the samples, controls then experimentals, into the
+	coefficient arrays and plot values of each group
+	"""
 	#### Initialize COEF arrays
 	COEFCTRL = np.zeros((len(ctrlBWNames), COEF_LEN), dtype=np.float64)
 	COEFEXPR = np.zeros((len(experiBWNames), COEF_LEN), dtype=np.float64)
@@ -37,24 +185,26 @@ def performRegression(trainingSet, covariates, ctrlBWNames, ctrlScaler, experiBW
 	experiPlotValues = {}
 
 	for i, bwFileName in enumerate(ctrlBWNames):
-		rawReadCounts = readCountData(bwFileName, trainingSet)
-		readCounts = getReadCounts(rawReadCounts, trainingSet.cumulativeRegionSize, ctrlScaler[i])
-		model = buildModel(readCounts, xView)
+		COEFCTRL[i, :], ctrlPlotValues[bwFileName] = sampleResults[i]
 
-		COEFCTRL[i, :] = getCoefs(model.params, covariates.selected)
+	for i, bwFileName in enumerate(experiBWNames):
+		COEFEXPR[i, :], experiPlotValues[bwFileName] = sampleResults[len(ctrlBWNames) + i]
 
-		ctrlPlotValues[bwFileName] = (readCounts[scatterplotSamples], model.fittedvalues[scatterplotSamples])
+	return COEFCTRL, COEFEXPR, ctrlPlotValues, experiPlotValues
 
-	for i, bwFileName in enumerate(experiBWNames):
-		rawReadCounts = readCountData(bwFileName, trainingSet)
-		readCounts = getReadCounts(rawReadCounts, trainingSet.cumulativeRegionSize, experiScaler[i])
-		model = buildModel(readCounts, xView)
+def performRegression(trainingSet, covariates, ctrlBWNames, ctrlScaler, experiBWNames, experiScaler, scatterplotSamples):
+	bwFileNames = list(ctrlBWNames) + list(experiBWNames)
+	scalers = list(ctrlScaler) + list(experiScaler)
 
-		COEFEXPR[i, :] = getCoefs(model.params, covariates.selected)
+	if trainingSet.cumulativeRegionSize > IN_MEMORY_REGRESSION_MAX_SIZE:
+		xView = None
+	else:
+		xView = getCovariateMatrix(trainingSet, covariates)
 
-		experiPlotValues[bwFileName] = (readCounts[scatterplotSamples], model.fittedvalues[scatterplotSamples])
+	# Every sample is fit to the same design matrix, so they are all fit together
+	sampleResults = fitSamples(trainingSet, covariates, xView, bwFileNames, scalers, scatterplotSamples)
 
-	return COEFCTRL, COEFEXPR, ctrlPlotValues, experiPlotValues
+	return collectResults(sampleResults, ctrlBWNames, experiBWNames)
 
 def readCountData(bwFileName, trainingSet):
 	with pyBigWig.open(bwFileName) as bwFile:
@@ -87,11 +237,17 @@ def getReadCounts(rawReadCounts, rowCount, scaler):
 
 	return readCounts
 
-def buildModel(readCounts, xView):
-	#### do regression
-	logLink = sm.genmod.families.links.log()
-	poisson = sm.families.Poisson(link=logLink)
-	return sm.GLM(np.array(readCounts).astype(int), np.array(xView), family=poisson).fit()
+def buildModels(readCounts, xView):
+	#### do regression, one model per column of readCounts
+	# The read counts are truncated to integers, as they were for the statsmodels GLM this replaces
+	models = glm.fitPoissonBatch(np.trunc(readCounts), xView)
+	warnUnconverged(models)
+	return models
+
+def warnUnconverged(models):
+	for model in models:
+		if not model.converged:
+			print(f"Warning! The regression didn't converge after {model.iterations} iterations (deviance: {model.deviance})")
 
 def getCoefs(modelParams, selectedCovariates):
 	coef = np.zeros(COEF_LEN, dtype=np.float64)
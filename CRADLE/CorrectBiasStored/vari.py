@@ -2,11 +2,19 @@ import os
 import sys
 import numpy as np
 
+from CRADLE.correctbiasutils import TRAINING_BIN_SIZE, covariateStore
+from CRADLE.correctbiasutils.shard import ShardException, parseShard
+
 def setGlobalVariables(args):
 	### input bigwig files
 	global I_GENERATE_NORM_BW
 	global I_NORM
 	global MIN_FRAG_FILTER_VALUE
+	global SHARD
+	global MODEL_FILE
+	global OUTPUT_FORMAT
+	global PREFETCH_DEPTH
+	global TRAINING_SIZE
 
 	sampleNum = len(args.ctrlbw) + len(args.expbw)
 
@@ -15,14 +23,28 @@ def setGlobalVariables(args):
 	setCovariDir(args.biasType, args.covariDir, args.genome)
 	seed = setRngSeed(args.rngSeed)
 	writeRngSeed(seed, args.o)
+	SHARD = setShard(args.shard)
+	MODEL_FILE = setModelFile(args.model, SHARD, args.o)
+	OUTPUT_FORMAT = args.outputFormat
+	PREFETCH_DEPTH = max(0, args.prefetch)
+	TRAINING_SIZE = setTrainingSize(args.trainingSize)
 
 class StoredCovariates:
-	__slots__ = ["directory", "name", "fragLen", "order", "selected", "num"]
+	__slots__ = ["directory", "name", "fragLen", "order", "selected", "num", "format"]
 
 	def __init__(self, biasTypes, directory):
 		self.directory = directory.rstrip('/')
 		self.name = self.directory.split('/')[-1]
 		self.fragLen = int(self.name.split('_')[1][7:]) # 7 = len("fragLen")
+
+		# Use the uncompressed, memory mapped store when the directory has one
+		if covariateStore.isNpyStore(self.directory):
+			self.format = "npy"
+			header = covariateStore.readHeader(self.directory)
+			if header["fragLen"] is not None:
+				self.fragLen = header["fragLen"]
+		else:
+			self.format = "hdf5"
 		self.order = ['Intercept']
 		self.selected = np.array([np.nan] * 6)
 
@@ -50,7 +72,12 @@ class StoredCovariates:
 		self.num = len(self.order) - 1
 
 	def covariateFileName(self, chromosome):
-		return self.directory + "/" + self.name + "_" + chromosome + ".hdf5"
+		if self.format == "npy":
+			return covariateStore.npyFileName(self.directory, chromosome)
+		return covariateStore.hdf5FileName(self.directory, chromosome)
+
+	def open(self, chromosome):
+		return covariateStore.CovariateFile(self.covariateFileName(chromosome), self.format)
 
 
 def getStoredCovariates(biasTypes, covariDir):
@@ -134,6 +161,30 @@ def setNormalization(norm, generateNormBW):
 	return generateNormBW, norm
 
 
+def setShard(shard):
+	try:
+		return parseShard(shard)
+	except ShardException as e:
+		print(f"Error! {e}")
+		sys.exit()
+
+
+def setTrainingSize(trainingSize):
+	if trainingSize < TRAINING_BIN_SIZE:
+		print(f"Error! -trainingSize should be at least {TRAINING_BIN_SIZE}")
+		sys.exit()
+
+	return trainingSize
+
+
+def setModelFile(modelFile, shard, outputDir):
+	# Every shard has to use the same model, so sharded runs always share one through a file
+	if modelFile is None and shard is not None:
+		return os.path.join(outputDir, "correction_model.npz")
+
+	return modelFile
+
+
 def setRngSeed(seed):
 	if seed is None:
 		seed = np.random.randint(0, 2**32 - 1)
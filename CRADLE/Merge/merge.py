@@ -0,0 +1,34 @@
+import sys
+import time
+
+import CRADLE.correctbiasutils.shard as shard
+
+from CRADLE.correctbiasutils import vari as commonVari
+
+
+def run(args):
+	startTime = time.perf_counter()
+
+	shardDir = args.shardDir.rstrip("/")
+	numProcess = commonVari.setNumProcess(args.p)
+
+	try:
+		manifests = shard.loadManifests(shardDir)
+	except shard.ShardException as e:
+		sys.exit(f"Error: {e}")
+
+	command = manifests[0]["command"]
+	print(f"* Merging {len(manifests)} shard(s) of '{command}'\n")
+
+	if command == "correctBias_stored":
+		from CRADLE.CorrectBiasStored.correctBias import mergeShards
+		mergeShards(manifests, shardDir)
+	elif command == "covariates":
+		from CRADLE.CalculateCovariates.covariates import mergeShards
+		mergeShards(manifests, shardDir, numProcess)
+	else:
+		sys.exit(f"Error: Unknown command in shard manifests: {command}")
+
+	shard.removeManifests(manifests, shardDir)
+
+	print(f"-- RUNNING TIME: {((time.perf_counter() - startTime)/3600)} hour(s)")
@@ -3,11 +3,9 @@ from __future__ import annotations
 import io
 import linecache
 import marshal
-import math
 import multiprocessing
 import os
 import os.path
-import struct
 import tempfile
 import matplotlib # type: ignore
 import matplotlib.pyplot as plt # type: ignore
@@ -19,24 +17,24 @@ from shutil import copyfile
 from typing import Iterator, List, Type
 
 from CRADLE.correctbiasutils.cython import arraySplit, coalesceSections # type: ignore
+from CRADLE.correctbiasutils.outputSinks import (
+	CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT,
+	MERGED_OUTPUT_FORMATS,
+	mergeCorrectedFilesToBW,
+	outputArrayChunkDir,
+	outputBWFile,
+	outputCorrectedTmpFile,
+)
 from CRADLE.logging import timer
 
 matplotlib.use('Agg')
 
 TRAINING_BIN_SIZE = 1_000
+# The default number of positions in the training sets
+TRAINING_SIZE = 1_000_000
 SCATTERPLOT_SAMPLE_COUNT = 10_000
 SONICATION_SHEAR_BIAS_OFFSET = 2
 
-CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT = "=LLf"
-
-# 10_000_000 here is a somewhat arbitrary choice, but I've tried 1_000_000 and
-# 100_000_000 on a significant run and not much changed.
-# 100_000_000:  --  Completed Merging Temp Files .... : 27.71366087388333 min(s)
-# 10_000_000:   --  Completed Merging Temp Files .... : 27.868539819183333 min(s)
-# 1_000_000:    --  Completed Merging Temp Files .... : 28.09171124881666 min(s)
-# I think 10_000_000 is a good memory tradeoff.
-MERGE_FILES_BUFFER_SIZE = 10_000_000
-
 # Used to adjust coordinates between 0 and 1-based systems.
 START_INDEX_ADJUSTMENT = 1
 
@@ -287,57 +285,24 @@ def getResultBWHeader(regions, ctrlBWName):
 	return resultBWHeader
 
 
-def outputBWFile(outputDir, filename):
-	signalBWName = '.'.join(filename.rsplit('/', 1)[-1].split(".")[:-1])
-	return os.path.join(outputDir, signalBWName + "_corrected.bw")
-
-
-def outputCorrectedTmpFile(outputDir, chromo, chromoId, filename):
-	signalBWName = '.'.join(filename.rsplit('/', 1)[-1].split(".")[:-1])
-	return os.path.join(outputDir, f"{signalBWName}_{chromo}_{chromoId}_corrected.tmp")
-
-
 def outputNormalizedTmpFile(outputDir, filename):
 	normObBWName = '.'.join(filename.rsplit('/', 1)[-1].split(".")[:-1])
 	return os.path.join(outputDir, normObBWName + "_normalized.tmp")
 
 
-def mergeBWFiles(outputDir, header, fileChromoInfo, ctrlBWNames, experiBWNames):
+def mergeBWFiles(outputDir, header, fileChromoInfo, ctrlBWNames, experiBWNames, outputFormat="bigwig"):
+	bwNames = ctrlBWNames + experiBWNames
+
+	if outputFormat not in MERGED_OUTPUT_FORMATS:
+		# The workers wrote the final array chunks themselves, there's nothing to merge
+		return [outputArrayChunkDir(outputDir, bwName) for bwName in bwNames]
+
+	outputFileName, mergeFunction = MERGED_OUTPUT_FORMATS[outputFormat]
 	jobList = []
-	for ctrlFile in ctrlBWNames:
-		jobList.append((ctrlFile, header, fileChromoInfo, outputBWFile(outputDir, ctrlFile), outputDir))
-	for experiFile in experiBWNames:
-		jobList.append((experiFile, header, fileChromoInfo, outputBWFile(outputDir, experiFile), outputDir))
-
-	return process(len(ctrlBWNames) + len(experiBWNames), mergeCorrectedFilesToBW, jobList)
-
-
-def mergeCorrectedFilesToBW(replicateFile, bwHeader, fileChromoInfo, signalBWName, outputDir):
-	signalBW = pyBigWig.open(signalBWName, "w")
-	signalBW.addHeader(bwHeader)
-	dataReadSize = struct.calcsize(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT) * MERGE_FILES_BUFFER_SIZE
-	starts = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.int32)
-	ends = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.int32)
-	values = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.float32)
-
-	for chromo, chromoId in fileChromoInfo:
-		chromos = [chromo] * MERGE_FILES_BUFFER_SIZE
-		tempFile = outputCorrectedTmpFile(outputDir, chromo, chromoId, replicateFile)
-		with open(tempFile, "rb") as dataFile:
-			data = dataFile.read(dataReadSize)
-			while data != b'':
-				total = 0
-				for start, end, value in struct.iter_unpack(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT, data):
-					starts[total] = start
-					ends[total] = end
-					values[total] = value
-					total += 1
-				signalBW.addEntries(chromos[:total], starts[:total], ends=ends[:total], values=values[:total])
-				data = dataFile.read(dataReadSize)
-		os.remove(tempFile)
-	signalBW.close()
-
-	return signalBWName
+	for bwName in bwNames:
+		jobList.append((bwName, header, fileChromoInfo, outputFileName(outputDir, bwName), outputDir))
+
+	return process(len(bwNames), mergeFunction, jobList)
 
 
 def divideGenome(regions, baseBinSize=1, genomeBinSize=50000):
@@ -535,8 +500,8 @@ def regionMeans(bwFile, binCount, chromo, start, end):
 
 
 @timer("Getting Candidate Training Sets", 1, "m")
-def getCandidateTrainingSet(rcPercentile, regions, ctrlBWName, outputDir):
-	trainRegionNum = math.pow(10, 6) / float(TRAINING_BIN_SIZE)
+def getCandidateTrainingSet(rcPercentile, regions, ctrlBWName, outputDir, trainingSize=TRAINING_SIZE):
+	trainRegionNum = trainingSize / float(TRAINING_BIN_SIZE)
 
 	meanRC = []
 	totalBinNum = 0
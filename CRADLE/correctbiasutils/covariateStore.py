@@ -0,0 +1,151 @@
+import glob
+import json
+import os
+import os.path
+import re
+
+import h5py # type: ignore
+import numpy as np
+
+# The covariate columns, in the order they are stored in both the HDF5 and npy formats
+COVARIATE_COLUMNS = ["MGW_shear", "ProT_shear", "Anneal_pcr", "Denature_pcr", "Map_map", "Gquad_gquad"]
+
+# npy stores are identified by this header file in the covariate directory
+HEADER_FILE_NAME = "covariates.json"
+STORE_VERSION = 1
+
+# How many rows of an HDF5 covariate file are converted at a time
+CONVERT_CHUNK_ROWS = 4_000_000
+
+
+class CovariateStoreException(Exception):
+	pass
+
+
+class CovariateFile:
+	"""The covariate values of one chromosome, from either an HDF5 file or a memory mapped npy file. `values`
+	supports the same slicing in both cases; slicing a memory mapped file doesn't copy or decompress anything.
+
+	chunkRows is the number of rows that are read (and decompressed) together, 1 for memory mapped files."""
+	__slots__ = ["_file", "values", "chunkRows"]
+
+	def __init__(self, fileName, storeFormat):
+		if storeFormat == "npy":
+			self._file = None
+			self.values = np.load(fileName, mmap_mode="r")
+			self.chunkRows = 1
+		else:
+			self._file = h5py.File(fileName, "r")
+			self.values = self._file['covari']
+			self.chunkRows = self.values.chunks[0] if self.values.chunks is not None else 1
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+		self.values = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+
+def storeName(directory):
+	return directory.rstrip('/').split('/')[-1]
+
+
+def hdf5FileName(directory, chromo):
+	directory = directory.rstrip('/')
+	return f"{directory}/{storeName(directory)}_{chromo}.hdf5"
+
+
+def npyFileName(directory, chromo):
+	directory = directory.rstrip('/')
+	return f"{directory}/{storeName(directory)}_{chromo}.npy"
+
+
+def headerFileName(directory):
+	return os.path.join(directory, HEADER_FILE_NAME)
+
+
+def isNpyStore(directory):
+	return os.path.isfile(headerFileName(directory))
+
+
+def readHeader(directory):
+	with open(headerFileName(directory)) as headerFile:
+		header = json.load(headerFile)
+
+	if header.get("version") != STORE_VERSION:
+		raise CovariateStoreException(f"Unsupported covariate store version in {headerFileName(directory)}")
+
+	return header
+
+
+def writeHeader(directory, header):
+	tempFileName = headerFileName(directory) + ".tmp"
+	with open(tempFileName, "w") as headerFile:
+		json.dump(header, headerFile, indent=1)
+	os.replace(tempFileName, headerFileName(directory))
+
+
+def parseStoreName(name):
+	"""Gets the fragment length and k-mer length from a directory named {genome}_fragLen{L}_kmer{k}"""
+	fragLen = re.search(r"_fragLen(\d+)", name)
+	kmer = re.search(r"_kmer(\d+)", name)
+	return (int(fragLen.group(1)) if fragLen else None), (int(kmer.group(1)) if kmer else None)
+
+
+def hdf5Chromosomes(directory):
+	prefix = hdf5FileName(directory, "")[:-len(".hdf5")]
+	return sorted(fileName[len(prefix):-len(".hdf5")] for fileName in glob.glob(glob.escape(prefix) + "*.hdf5"))
+
+
+def convertHDF5File(hdf5File, npyFile):
+	with h5py.File(hdf5File, "r") as f:
+		covariates = f['covari']
+		rowCount, columnCount = covariates.shape
+
+		# Write to a temp file and rename it so an interrupted conversion never leaves a truncated store file
+		tempFileName = npyFile + ".tmp.npy"
+		output = np.lib.format.open_memmap(tempFileName, mode="w+", dtype=np.float32, shape=(rowCount, columnCount))
+		for start in range(0, rowCount, CONVERT_CHUNK_ROWS):
+			end = min(start + CONVERT_CHUNK_ROWS, rowCount)
+			output[start:end] = covariates[start:end]
+		output.flush()
+		del output
+
+	os.replace(tempFileName, npyFile)
+
+	return rowCount
+
+
+def convertHDF5Store(hdf5Dir, npyDir):
+	""" Converts the {name}_{chromo}.hdf5 covariate files in _hdf5Dir_ to a npy store in _npyDir_.
+	_npyDir_ can be the same directory.
+	"""
+	chromos = hdf5Chromosomes(hdf5Dir)
+	if len(chromos) == 0:
+		raise CovariateStoreException(f"There are no covariate hdf5 files in {hdf5Dir}")
+
+	os.makedirs(npyDir, exist_ok=True)
+
+	chromoLengths = {}
+	for chromo in chromos:
+		print(f"* {chromo}")
+		chromoLengths[chromo] = convertHDF5File(hdf5FileName(hdf5Dir, chromo), npyFileName(npyDir, chromo))
+
+	fragLen, kmer = parseStoreName(storeName(npyDir))
+
+	header = {
+		"version": STORE_VERSION,
+		"fragLen": fragLen,
+		"kmer": kmer,
+		"columns": COVARIATE_COLUMNS,
+		"dtype": "float32",
+		"chromosomes": chromoLengths,
+	}
+	writeHeader(npyDir, header)
+
+	return [npyFileName(npyDir, chromo) for chromo in chromos]
@@ -0,0 +1,263 @@
+import numpy as np
+
+# The number of rows of the design matrix processed at a time. Bounds the size of the temporaries
+# created while accumulating X'WX and X'Wz.
+IRLS_BLOCK_SIZE = 4_096
+
+# From this many responses on, the pairwise column products of X are shared by all the responses' X'WX
+# instead of weighting X separately for each response
+SHARED_PRODUCTS_MIN_RESPONSES = 3
+
+# The same defaults statsmodels uses for GLM(...).fit()
+MAX_ITERATIONS = 100
+DEVIANCE_TOLERANCE = 1e-8
+
+FLOAT_EPS = np.finfo(float).eps
+
+
+class PoissonFitResult:
+	"""The result of fitPoisson.
+
+	params: the fitted coefficients
+	fittedvalues: the fitted mean (exp(X @ params)) of every row
+	deviance: the deviance of the fit
+	iterations: the number of IRLS iterations run
+	converged: whether the change in deviance got below the tolerance before the iteration limit
+	"""
+	__slots__ = ["params", "fittedvalues", "deviance", "iterations", "converged"]
+
+	def __init__(self, params, fittedvalues, deviance, iterations, converged):
+		self.params = params
+		self.fittedvalues = fittedvalues
+		self.deviance = deviance
+		self.iterations = iterations
+		self.converged = converged
+
+
+def linearPredictors(X, params):
+	"""params @ X.T in float64, one row per row of _params_, without converting all of a (possibly float32) X
+	at once"""
+	rowCount = X.shape[0]
+	eta = np.empty((params.shape[0], rowCount), dtype=np.float64)
+	for blockStart in range(0, rowCount, IRLS_BLOCK_SIZE):
+		blockEnd = min(blockStart + IRLS_BLOCK_SIZE, rowCount)
+		eta[:, blockStart:blockEnd] = params @ np.asarray(X[blockStart:blockEnd], dtype=np.float64).T
+
+	return eta
+
+
+def weightedNormalEquations(X, weights, z):
+	""" Accumulates X'WX and X'Wz for every row of _weights_ and _z_ (responses x rows), reading X only once,
+	block by block.
+
+	With several responses, the products of each pair of columns of a block (only the upper triangle, X'WX is
+	symmetric) are computed once and X'WX of all the responses is a single matrix product with the weights.
+	"""
+	rowCount, columnCount = X.shape
+	responseCount = weights.shape[0]
+	xtwz = np.zeros((responseCount, columnCount), dtype=np.float64)
+
+	if responseCount < SHARED_PRODUCTS_MIN_RESPONSES:
+		xtwx = np.zeros((responseCount, columnCount, columnCount), dtype=np.float64)
+		weightedX = np.empty((min(IRLS_BLOCK_SIZE, rowCount), columnCount), dtype=np.float64)
+		for blockStart in range(0, rowCount, IRLS_BLOCK_SIZE):
+			blockEnd = min(blockStart + IRLS_BLOCK_SIZE, rowCount)
+			blockX = np.asarray(X[blockStart:blockEnd], dtype=np.float64)
+			blockWeightedX = weightedX[:blockEnd - blockStart]
+			for i in range(responseCount):
+				np.multiply(blockX, weights[i, blockStart:blockEnd, None], out=blockWeightedX)
+				xtwx[i] += blockWeightedX.T @ blockX
+				xtwz[i] += z[i, blockStart:blockEnd] @ blockWeightedX
+
+		return xtwx, xtwz
+
+	upperRows, upperColumns = np.triu_indices(columnCount)
+	xtwxUpper = np.zeros((responseCount, len(upperRows)), dtype=np.float64)
+	for blockStart in range(0, rowCount, IRLS_BLOCK_SIZE):
+		blockEnd = min(blockStart + IRLS_BLOCK_SIZE, rowCount)
+		blockXT = np.ascontiguousarray(np.asarray(X[blockStart:blockEnd], dtype=np.float64).T)
+		columnProducts = blockXT[upperRows]
+		columnProducts *= blockXT[upperColumns]
+
+		blockWeights = weights[:, blockStart:blockEnd]
+		xtwxUpper += blockWeights @ columnProducts.T
+		xtwz += (blockWeights * z[:, blockStart:blockEnd]) @ blockXT.T
+
+	xtwx = np.empty((responseCount, columnCount, columnCount), dtype=np.float64)
+	xtwx[:, upperRows, upperColumns] = xtwxUpper
+	xtwx[:, upperColumns, upperRows] = xtwxUpper
+
+	return xtwx, xtwz
+
+
+def solveNormalEquations(xtwx, xtwz):
+	""" Solves X'WX b = X'Wz. The columns are scaled to unit diagonal first, which keeps the system well
+	conditioned even when the covariates have very different magnitudes. Like statsmodels' pinv, a
+	rank deficient system gets the minimum norm solution.
+	"""
+	scale = np.sqrt(np.diag(xtwx))
+	scale[scale == 0] = 1.0
+	scaledXtwx = xtwx / np.outer(scale, scale)
+	scaledParams = np.linalg.lstsq(scaledXtwx, xtwz / scale, rcond=None)[0]
+
+	return scaledParams / scale
+
+
+def poissonDeviance(y, mu):
+	"""The deviance of _y_, or of each row of a 2D _y_"""
+	return 2 * np.sum(y * np.log(np.clip(y / mu, FLOAT_EPS, np.inf)) - (y - mu), axis=-1)
+
+
+def fitPoissonBatch(Y, X, startParams=None, maxIterations=MAX_ITERATIONS, tolerance=DEVIANCE_TOLERANCE):
+	""" Fits a Poisson GLM with a log link to every column of _Y_ (rows x responses) by iteratively reweighted
+	least squares, all against the same design matrix _X_. Every iteration reads X once for all the responses
+	still being fit; a response drops out as soon as it converges. Returns a PoissonFitResult per column.
+
+	Each fit is the same algorithm, starting point and stopping rule (change in deviance <= _tolerance_) as
+	statsmodels' GLM(y, X, family=Poisson()).fit(). X isn't copied and can be float64 or float32. Y is used as
+	given; statsmodels callers usually truncate it to integers first.
+
+	_startParams_ (one row of coefficients, or one per response) warm starts the fits.
+	"""
+	# Each response's values are kept contiguous
+	Y = np.ascontiguousarray(np.asarray(Y, dtype=np.float64).T)
+	responseCount = Y.shape[0]
+	columnCount = X.shape[1]
+
+	if startParams is None:
+		params = np.zeros((responseCount, columnCount), dtype=np.float64)
+		mu = (Y + Y.mean(axis=1, keepdims=True)) / 2
+		eta = np.log(mu)
+	else:
+		params = np.array(np.broadcast_to(np.asarray(startParams, dtype=np.float64), (responseCount, columnCount)))
+		eta = linearPredictors(X, params)
+		mu = np.exp(eta)
+
+	deviances = np.array([poissonDeviance(Y[i], mu[i]) for i in range(responseCount)])
+	if np.isnan(deviances).any():
+		raise ValueError("The first guess on the deviance function returned a nan")
+
+	iterations = np.zeros(responseCount, dtype=np.int64)
+	converged = np.zeros(responseCount, dtype=bool)
+	active = list(range(responseCount))
+	for iteration in range(1, maxIterations + 1):
+		# For a Poisson GLM with a log link the IRLS weights are mu and the working response is eta + (y - mu) / mu
+		z = np.empty((len(active), Y.shape[1]), dtype=np.float64)
+		for i, response in enumerate(active):
+			np.subtract(Y[response], mu[response], out=z[i])
+			z[i] /= mu[response]
+			z[i] += eta[response]
+		xtwx, xtwz = weightedNormalEquations(X, mu[active], z)
+		for i, response in enumerate(active):
+			params[response] = solveNormalEquations(xtwx[i], xtwz[i])
+
+		eta[active] = linearPredictors(X, params[active])
+		for response in active:
+			np.exp(eta[response], out=mu[response])
+
+			deviance = poissonDeviance(Y[response], mu[response])
+			converged[response] = abs(deviance - deviances[response]) <= tolerance
+			deviances[response] = deviance
+			iterations[response] = iteration
+
+		active = [response for response in active if not converged[response]]
+		if len(active) == 0:
+			break
+
+	return [
+		PoissonFitResult(params[i], mu[i], float(deviances[i]), int(iterations[i]), bool(converged[i]))
+		for i in range(responseCount)
+	]
+
+
+def fitPoisson(y, X, startParams=None, maxIterations=MAX_ITERATIONS, tolerance=DEVIANCE_TOLERANCE):
+	"""fitPoissonBatch for a single response _y_"""
+	y = np.asarray(y, dtype=np.float64)
+	return fitPoissonBatch(y[:, None], X, startParams, maxIterations, tolerance)[0]
+
+
+def fitPoissonStreamed(blocks, responseCount, fittedRows=None, maxIterations=MAX_ITERATIONS, tolerance=DEVIANCE_TOLERANCE):
+	""" fitPoissonBatch for data that doesn't have to fit in memory. _blocks_(includeX) returns an iterable of
+	(Y, X) row blocks, Y being (rows x responses) and X None when includeX is False. Every call has to return
+	the same blocks in the same order.
+
+	Only X'WX, X'Wz and the deviance of each response are kept between blocks, so memory use depends on the
+	block size, not on the number of rows. Every iteration takes one pass over the blocks (plus one pass
+	over Y for the starting point).
+
+	The fitted values are only kept for _fittedRows_ (indices of rows, counted over all the blocks):
+	PoissonFitResult.fittedvalues[i] is the fitted value of row fittedRows[i].
+	"""
+	fittedRows = np.asarray([] if fittedRows is None else fittedRows, dtype=np.int64)
+
+	# The statsmodels starting point needs the mean of every response
+	ySums = np.zeros(responseCount, dtype=np.float64)
+	rowCount = 0
+	for Y, _ in blocks(False):
+		ySums += np.sum(Y, axis=0)
+		rowCount += len(Y)
+	yMeans = ySums / rowCount
+
+	params = None
+	deviances = np.zeros(responseCount, dtype=np.float64)
+	fittedValues = np.zeros((responseCount, len(fittedRows)), dtype=np.float64)
+	iterations = np.zeros(responseCount, dtype=np.int64)
+	converged = np.zeros(responseCount, dtype=bool)
+	active = np.arange(responseCount)
+
+	# Pass i evaluates the coefficients of iteration i (or the starting point) and accumulates the normal
+	# equations that give the coefficients of iteration i + 1
+	for iteration in range(maxIterations + 1):
+		xtwx = None
+		xtwz = None
+		newDeviances = np.zeros(len(active), dtype=np.float64)
+
+		blockStart = 0
+		for Y, X in blocks(True):
+			Y = np.ascontiguousarray(np.asarray(Y, dtype=np.float64)[:, active].T)
+			blockEnd = blockStart + Y.shape[1]
+
+			if params is None:
+				mu = (Y + yMeans[active, None]) / 2
+				eta = np.log(mu)
+			else:
+				eta = linearPredictors(X, params[active])
+				mu = np.exp(eta)
+
+			newDeviances += poissonDeviance(Y, mu)
+
+			blockFittedRows = np.where((fittedRows >= blockStart) & (fittedRows < blockEnd))[0]
+			if len(blockFittedRows) > 0:
+				fittedValues[active[:, None], blockFittedRows] = mu[:, fittedRows[blockFittedRows] - blockStart]
+
+			# For a Poisson GLM with a log link the IRLS weights are mu and the working response is eta + (y - mu) / mu
+			z = eta + (Y - mu) / mu
+			blockXtwx, blockXtwz = weightedNormalEquations(X, mu, z)
+			xtwx = blockXtwx if xtwx is None else xtwx + blockXtwx
+			xtwz = blockXtwz if xtwz is None else xtwz + blockXtwz
+
+			blockStart = blockEnd
+
+		if params is None:
+			if np.isnan(newDeviances).any():
+				raise ValueError("The first guess on the deviance function returned a nan")
+			params = np.zeros((responseCount, xtwx.shape[1]), dtype=np.float64)
+		else:
+			converged[active] = np.abs(newDeviances - deviances[active]) <= tolerance
+		deviances[active] = newDeviances
+		iterations[active] = iteration
+
+		if iteration == maxIterations:
+			break
+
+		stillActive = ~converged[active]
+		for i in np.where(stillActive)[0]:
+			params[active[i]] = solveNormalEquations(xtwx[i], xtwz[i])
+		active = active[stillActive]
+		if len(active) == 0:
+			break
+
+	return [
+		PoissonFitResult(params[i], fittedValues[i], float(deviances[i]), int(iterations[i]), bool(converged[i]))
+		for i in range(responseCount)
+	]
@@ -0,0 +1,161 @@
+import os
+import os.path
+import struct
+
+import h5py # type: ignore
+import numpy as np
+import pyBigWig # type: ignore
+
+CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT = "=LLf"
+
+# 10_000_000 here is a somewhat arbitrary choice, but I've tried 1_000_000 and
+# 100_000_000 on a significant run and not much changed.
+# 100_000_000:  --  Completed Merging Temp Files .... : 27.71366087388333 min(s)
+# 10_000_000:   --  Completed Merging Temp Files .... : 27.868539819183333 min(s)
+# 1_000_000:    --  Completed Merging Temp Files .... : 28.09171124881666 min(s)
+# I think 10_000_000 is a good memory tradeoff.
+MERGE_FILES_BUFFER_SIZE = 10_000_000
+
+OUTPUT_FORMATS = ["bigwig", "bedgraph", "npz", "hdf5"]
+
+
+def sampleName(filename):
+	return '.'.join(filename.rsplit('/', 1)[-1].split(".")[:-1])
+
+
+def outputBWFile(outputDir, filename):
+	return os.path.join(outputDir, sampleName(filename) + "_corrected.bw")
+
+
+def outputBedGraphFile(outputDir, filename):
+	return os.path.join(outputDir, sampleName(filename) + "_corrected.bedGraph")
+
+
+def outputCorrectedTmpFile(outputDir, chromo, chromoId, filename):
+	return os.path.join(outputDir, f"{sampleName(filename)}_{chromo}_{chromoId}_corrected.tmp")
+
+
+def outputArrayChunkDir(outputDir, filename):
+	return os.path.join(outputDir, sampleName(filename) + "_corrected")
+
+
+def outputArrayChunkFile(outputDir, chromo, chromoId, filename, extension):
+	return os.path.join(outputArrayChunkDir(outputDir, filename), f"{chromo}_{chromoId}.{extension}")
+
+
+class TempRecordWriter:
+	"""Writes corrected read count sections to a temp file of fixed size binary records. The temp files of
+	each sample are merged, in order, into one output file once all the workers are done."""
+	__slots__ = ["file"]
+
+	def __init__(self, fileName):
+		self.file = open(fileName, "wb")
+
+	def write(self, sectionCount, starts, ends, values):
+		for i in range(sectionCount):
+			self.file.write(struct.pack(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT, starts[i], ends[i], values[i]))
+
+	def close(self):
+		self.file.close()
+
+
+class ArrayChunkWriter:
+	"""Collects corrected read count sections and writes them as arrays (start, end, value) to their own
+	final chunk file. Every chunk covers a different part of a chromosome, so workers can write them in
+	parallel and no merge step is needed."""
+	__slots__ = ["fileName", "extension", "starts", "ends", "values"]
+
+	def __init__(self, fileName, extension):
+		self.fileName = fileName
+		self.extension = extension
+		self.starts = []
+		self.ends = []
+		self.values = []
+
+	def write(self, sectionCount, starts, ends, values):
+		self.starts.append(np.asarray(starts[:sectionCount], dtype=np.uint32))
+		self.ends.append(np.asarray(ends[:sectionCount], dtype=np.uint32))
+		self.values.append(np.asarray(values[:sectionCount], dtype=np.float32))
+
+	def close(self):
+		starts = np.concatenate(self.starts) if len(self.starts) > 0 else np.zeros(0, dtype=np.uint32)
+		ends = np.concatenate(self.ends) if len(self.ends) > 0 else np.zeros(0, dtype=np.uint32)
+		values = np.concatenate(self.values) if len(self.values) > 0 else np.zeros(0, dtype=np.float32)
+
+		# Write to a temp file and rename it so a partially written chunk is never mistaken for a finished one
+		tempFileName = f"{self.fileName}.tmp"
+		if self.extension == "npz":
+			with open(tempFileName, "wb") as chunkFile:
+				np.savez(chunkFile, start=starts, end=ends, value=values)
+		else:
+			with h5py.File(tempFileName, "w") as chunkFile:
+				chunkFile.create_dataset("start", data=starts)
+				chunkFile.create_dataset("end", data=ends)
+				chunkFile.create_dataset("value", data=values)
+		os.replace(tempFileName, self.fileName)
+
+
+def openCorrectedReadsWriter(outputFormat, outputDir, chromo, chromoId, bwName):
+	"""Opens the writer a worker uses to output the corrected read counts of _bwName_ in one chromosome chunk"""
+	if outputFormat in ("npz", "hdf5"):
+		os.makedirs(outputArrayChunkDir(outputDir, bwName), exist_ok=True)
+		return ArrayChunkWriter(outputArrayChunkFile(outputDir, chromo, chromoId, bwName, outputFormat), outputFormat)
+
+	return TempRecordWriter(outputCorrectedTmpFile(outputDir, chromo, chromoId, bwName))
+
+
+def readTempRecords(tempFileName):
+	"""Yields the (starts, ends, values) of a temp file in blocks of at most MERGE_FILES_BUFFER_SIZE records"""
+	dataReadSize = struct.calcsize(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT) * MERGE_FILES_BUFFER_SIZE
+	starts = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.int32)
+	ends = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.int32)
+	values = np.zeros(MERGE_FILES_BUFFER_SIZE, dtype=np.float32)
+
+	with open(tempFileName, "rb") as dataFile:
+		data = dataFile.read(dataReadSize)
+		while data != b'':
+			total = 0
+			for start, end, value in struct.iter_unpack(CORRECTED_RC_TEMP_FILE_STRUCT_FORMAT, data):
+				starts[total] = start
+				ends[total] = end
+				values[total] = value
+				total += 1
+			yield starts[:total], ends[:total], values[:total]
+			data = dataFile.read(dataReadSize)
+
+
+def mergeCorrectedFilesToBW(replicateFile, bwHeader, fileChromoInfo, signalBWName, outputDir):
+	signalBW = pyBigWig.open(signalBWName, "w")
+	signalBW.addHeader(bwHeader)
+
+	for chromo, chromoId in fileChromoInfo:
+		chromos = [chromo] * MERGE_FILES_BUFFER_SIZE
+		tempFile = outputCorrectedTmpFile(outputDir, chromo, chromoId, replicateFile)
+		for starts, ends, values in readTempRecords(tempFile):
+			total = len(starts)
+			signalBW.addEntries(chromos[:total], starts, ends=ends, values=values)
+		os.remove(tempFile)
+	signalBW.close()
+
+	return signalBWName
+
+
+def mergeCorrectedFilesToBedGraph(replicateFile, bwHeader, fileChromoInfo, signalBedGraphName, outputDir):
+	with open(signalBedGraphName, "w") as signalBedGraph:
+		for chromo, chromoId in fileChromoInfo:
+			tempFile = outputCorrectedTmpFile(outputDir, chromo, chromoId, replicateFile)
+			for starts, ends, values in readTempRecords(tempFile):
+				signalBedGraph.writelines(
+					f"{chromo}\t{start}\t{end}\t{value:.9g}\n" for start, end, value in zip(starts.tolist(), ends.tolist(), values.tolist())
+				)
+			os.remove(tempFile)
+
+	return signalBedGraphName
+
+
+# outputFormat -> (output file name function, merge function). The array formats are written directly
+# by the workers, so they have no merge step.
+MERGED_OUTPUT_FORMATS = {
+	"bigwig": (outputBWFile, mergeCorrectedFilesToBW),
+	"bedgraph": (outputBedGraphFile, mergeCorrectedFilesToBedGraph),
+}
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+
+# Markers for the items on a Prefetcher's queue
+_RESULT = 0
+_ERROR = 1
+_DONE = 2
+
+# How often (in seconds) a blocked loader thread checks whether the consumer has gone away
+_PUT_TIMEOUT = 0.1
+
+
+class Prefetcher:
+	"""Calls _loader_ on each argument tuple in _items_ in a background thread, keeping up to _depth_ results
+	ready ahead of the consumer. Iterating over a Prefetcher yields the results in order.
+
+	With a depth of 0 everything is loaded synchronously, in the consumer's thread.
+
+	loadTime is the total time spent in _loader_. stallTime is the total time the consumer spent waiting
+	for results, i.e., the part of loadTime that wasn't hidden behind the consumer's own work.
+	"""
+	__slots__ = ["loader", "items", "depth", "loadTime", "stallTime"]
+
+	def __init__(self, loader, items, depth):
+		self.loader = loader
+		self.items = items
+		self.depth = depth
+		self.loadTime = 0.0
+		self.stallTime = 0.0
+
+	def __iter__(self):
+		if self.depth <= 0:
+			yield from self._loadSynchronously()
+			return
+
+		results = queue.Queue(self.depth)
+		stop = threading.Event()
+		thread = threading.Thread(target=self._load, args=(results, stop), daemon=True)
+		thread.start()
+
+		try:
+			while True:
+				waitStart = time.perf_counter()
+				kind, value = results.get()
+				self.stallTime += time.perf_counter() - waitStart
+
+				if kind == _DONE:
+					break
+				if kind == _ERROR:
+					raise value
+				yield value
+		finally:
+			stop.set()
+			thread.join()
+
+	def _loadSynchronously(self):
+		for item in self.items:
+			loadStart = time.perf_counter()
+			result = self.loader(*item)
+			loadTime = time.perf_counter() - loadStart
+			self.loadTime += loadTime
+			self.stallTime += loadTime
+			yield result
+
+	def _load(self, results, stop):
+		try:
+			for item in self.items:
+				loadStart = time.perf_counter()
+				result = self.loader(*item)
+				self.loadTime += time.perf_counter() - loadStart
+
+				if not _put(results, (_RESULT, result), stop):
+					return
+			_put(results, (_DONE, None), stop)
+		except Exception as e:
+			_put(results, (_ERROR, e), stop)
+
+
+def _put(results, value, stop):
+	"""Puts _value_ on the _results_ queue unless the consumer stops first. Returns False if it stopped."""
+	while not stop.is_set():
+		try:
+			results.put(value, timeout=_PUT_TIMEOUT)
+			return True
+		except queue.Full:
+			continue
+	return False
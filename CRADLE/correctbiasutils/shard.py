@@ -0,0 +1,136 @@
+import glob
+import json
+import os
+import os.path
+import time
+
+from typing import List, Optional, Tuple
+
+# Manifests are written next to the partial outputs of a shard. `merge` finds them by this suffix.
+MANIFEST_SUFFIX = ".manifest.json"
+
+# How often (in seconds) a shard waiting on another shard's training checks for the model file
+MODEL_WAIT_INTERVAL = 10
+
+
+class ShardException(Exception):
+	pass
+
+
+def parseShard(shard: Optional[str]) -> Optional[Tuple[int, int]]:
+	"""Parses a "-shard i/N" value into (i, N). Shards are numbered starting from 1."""
+	if shard is None:
+		return None
+
+	try:
+		shardIndex, shardCount = (int(x) for x in shard.split("/"))
+	except ValueError:
+		raise ShardException(f"Invalid -shard value '{shard}'. It should look like 'i/N', e.g. '1/4'")
+
+	if shardCount < 1 or shardIndex < 1 or shardIndex > shardCount:
+		raise ShardException(f"Invalid -shard value '{shard}'. 'i' should be between 1 and N")
+
+	return shardIndex, shardCount
+
+
+def shardRegions(regions: List[Tuple[str, int, int]], shardIndex: int, shardCount: int) -> List[Tuple[str, int, int]]:
+	"""Selects the regions (as generated by divideGenome) assigned to shard _shardIndex_ of _shardCount_.
+
+	Each shard gets a contiguous run of regions covering roughly the same number of base pairs, so every
+	shard can compute its part independently and get the same answer.
+	"""
+	totalBaseCount = sum(end - start for _, start, end in regions)
+	if totalBaseCount == 0:
+		return []
+
+	selectedRegions = []
+	currentBaseCount = 0
+	for chromo, start, end in regions:
+		regionLength = end - start
+		# Assign a region to the shard its midpoint falls into
+		midpoint = currentBaseCount + regionLength / 2
+		regionShard = min(int(midpoint * shardCount / totalBaseCount), shardCount - 1) + 1
+		if regionShard == shardIndex:
+			selectedRegions.append((chromo, start, end))
+		currentBaseCount += regionLength
+
+	return selectedRegions
+
+
+def manifestFileName(outputDir: str, shardIndex: int, shardCount: int) -> str:
+	return os.path.join(outputDir, f"shard_{shardIndex}_of_{shardCount}{MANIFEST_SUFFIX}")
+
+
+def writeManifest(outputDir: str, shardIndex: int, shardCount: int, command: str, manifest: dict) -> str:
+	manifest = dict(manifest, command=command, shardIndex=shardIndex, shardCount=shardCount)
+
+	fileName = manifestFileName(outputDir, shardIndex, shardCount)
+	writeJSONAtomically(fileName, manifest)
+
+	return fileName
+
+
+def loadManifests(shardDir: str) -> List[dict]:
+	"""Loads the manifests of all the shards in _shardDir_, ordered by shard index. Every shard of the run
+	must have finished."""
+	manifests = []
+	for fileName in glob.glob(os.path.join(shardDir, f"*{MANIFEST_SUFFIX}")):
+		with open(fileName) as manifestFile:
+			manifests.append(json.load(manifestFile))
+
+	if len(manifests) == 0:
+		raise ShardException(f"No shard manifests were found in {shardDir}")
+
+	manifests.sort(key=lambda manifest: manifest["shardIndex"])
+
+	shardCount = manifests[0]["shardCount"]
+	command = manifests[0]["command"]
+	for manifest in manifests:
+		if manifest["shardCount"] != shardCount or manifest["command"] != command:
+			raise ShardException(f"The manifests in {shardDir} are from different runs")
+
+	missingShards = set(range(1, shardCount + 1)) - {manifest["shardIndex"] for manifest in manifests}
+	if len(missingShards) > 0:
+		raise ShardException(f"Shard(s) {sorted(missingShards)} of {shardCount} haven't finished")
+
+	return manifests
+
+
+def removeManifests(manifests: List[dict], shardDir: str) -> None:
+	for manifest in manifests:
+		os.remove(manifestFileName(shardDir, manifest["shardIndex"], manifest["shardCount"]))
+
+
+def writeJSONAtomically(fileName: str, data: dict) -> None:
+	# Write to a temp file and rename it so readers on a shared filesystem never see a partial file
+	tempFileName = f"{fileName}.{os.getpid()}.tmp"
+	with open(tempFileName, "w") as tempFile:
+		json.dump(data, tempFile)
+	os.replace(tempFileName, fileName)
+
+
+def acquireLock(lockFileName: str) -> bool:
+	"""Creates _lockFileName_ if it doesn't exist. Returns True if this process created it. O_EXCL creation
+	is atomic on local and NFS (v3+) filesystems, so no other coordination is needed."""
+	try:
+		fd = os.open(lockFileName, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+	except FileExistsError:
+		return False
+
+	os.write(fd, f"{os.getpid()}\n".encode())
+	os.close(fd)
+	return True
+
+
+def releaseLock(lockFileName: str) -> None:
+	if os.path.exists(lockFileName):
+		os.remove(lockFileName)
+
+
+def waitForFile(fileName: str, lockFileName: str) -> None:
+	"""Waits until another process creates _fileName_. Gives up if that process releases its lock
+	without creating the file."""
+	while not os.path.exists(fileName):
+		if not os.path.exists(lockFileName) and not os.path.exists(fileName):
+			raise ShardException(f"{fileName} was never created. Did the shard creating it fail?")
+		time.sleep(MODEL_WAIT_INTERVAL)
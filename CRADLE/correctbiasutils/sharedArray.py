@@ -0,0 +1,45 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+	""" A numpy array in shared memory. The process that creates it passes `descriptor` to worker processes,
+	which attach to the same memory instead of getting their own copy of the array.
+
+	The creator's close() also frees the memory, so it should only be called once the workers are done. Any
+	references to `array` have to be gone before close() is called.
+	"""
+	__slots__ = ["_sharedMemory", "_owner", "array"]
+
+	def __init__(self, sharedMemory, shape, dtype, owner):
+		self._sharedMemory = sharedMemory
+		self._owner = owner
+		self.array = np.ndarray(shape, dtype=dtype, buffer=sharedMemory.buf)
+
+	@classmethod
+	def create(cls, shape, dtype):
+		"""A new, uninitialized, shared array"""
+		size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+		return cls(shared_memory.SharedMemory(create=True, size=size), shape, dtype, True)
+
+	@classmethod
+	def attach(cls, descriptor):
+		name, shape, dtype = descriptor
+		return cls(shared_memory.SharedMemory(name=name), shape, dtype, False)
+
+	@property
+	def descriptor(self):
+		return (self._sharedMemory.name, self.array.shape, self.array.dtype.str)
+
+	def close(self):
+		self.array = None
+		self._sharedMemory.close()
+		if self._owner:
+			self._sharedMemory.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
@@ -0,0 +1,42 @@
+import h5py
+import numpy as np
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils import ChromoRegion, ChromoRegionSet
+from CRADLE.CorrectBiasStored.regression import COVARIATE_FILE_INDEX_OFFSET, getCovariateMatrix, groupRegionsForReading
+from CRADLE.CorrectBiasStored.vari import StoredCovariates
+
+@pytest.mark.parametrize("regions,maxGap,result", [
+	([(0, 10, 0), (10, 20, 10)], 1, [[0, 20, [(0, 10, 0), (10, 20, 10)]]]),
+	([(0, 10, 0), (11, 20, 10)], 1, [[0, 10, [(0, 10, 0)]], [11, 20, [(11, 20, 10)]]]),
+	([(0, 10, 0), (50, 60, 10)], 100, [[0, 60, [(0, 10, 0), (50, 60, 10)]]]),
+	([(0, 30, 0), (5, 10, 30)], 1, [[0, 30, [(0, 30, 0), (5, 10, 30)]]]),
+])
+def testGroupRegionsForReading(regions, maxGap, result):
+	assert groupRegionsForReading(regions, maxGap) == result
+
+@pytest.mark.parametrize("chunks", [None, (7, 6)])
+def testGetCovariateMatrix(tmp_path, chunks):
+	covariDir = tmp_path / "test_fragLen10_kmer5"
+	covariDir.mkdir()
+	rng = np.random.default_rng(0)
+	chromoValues = {"chr1": rng.random((200, 6), dtype=np.float32), "chr2": rng.random((100, 6), dtype=np.float32)}
+	for chromo, values in chromoValues.items():
+		with h5py.File(covariDir / f"test_fragLen10_kmer5_{chromo}.hdf5", "w") as f:
+			f.create_dataset("covari", data=values, chunks=chunks)
+
+	trainingSet = ChromoRegionSet([
+		ChromoRegion("chr2", 50, 60), ChromoRegion("chr1", 100, 130), ChromoRegion("chr1", 10, 20), ChromoRegion("chr2", 5, 8)
+	])
+	covariates = StoredCovariates(["shear", "map"], str(covariDir))
+
+	xView = getCovariateMatrix(trainingSet, covariates)
+
+	selectedColumns = [0, 1, 4]
+	expected = np.concatenate([
+		chromoValues[region.chromo][region.start - COVARIATE_FILE_INDEX_OFFSET:region.end - COVARIATE_FILE_INDEX_OFFSET][:, selectedColumns]
+		for region in trainingSet
+	])
+	assert np.array_equal(xView[:, 0], np.ones(trainingSet.cumulativeRegionSize))
+	assert np.array_equal(xView[:, 1:], expected)
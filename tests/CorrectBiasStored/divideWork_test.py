@@ -4,7 +4,7 @@ import pyximport; pyximport.install()
 
 from CRADLE.correctbiasutils import ChromoRegionSet
 from CRADLE.correctbiasutils import divideGenome
-from CRADLE.CorrectBiasStored.correctBias import divideWork, divideWorkByChrom
+from CRADLE.CorrectBiasStored.correctBias import divideWork, divideWorkByChrom, regressionSampleGroups
 
 @pytest.mark.parametrize("regionFile,blacklistFile,processCount,jobGroupCount", [
 	('tests/files/regions/actual_probes_hg38_merged.bed', 'tests/files/regions/hg38_filter_out.bed', 100, 100),
@@ -40,3 +40,13 @@ def testDivideWork(regionFile, blacklistFile, processCount, jobGroupCount):
 
 	assert len(jobGroups) <= processCount
 	assert len(jobGroups) == jobGroupCount
+
+@pytest.mark.parametrize("sampleCount,numProcess,groups", [
+	(4, 1, [[0, 1, 2, 3]]),
+	(4, 2, [[0, 1, 2, 3]]),
+	(4, 4, [[0, 1], [2, 3]]),
+	(3, 4, [[0, 1], [2]]),
+	(4, 16, [[0], [1], [2], [3]]),
+])
+def testRegressionSampleGroups(sampleCount, numProcess, groups):
+	assert regressionSampleGroups(sampleCount, numProcess) == groups
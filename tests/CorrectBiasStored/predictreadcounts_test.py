@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import pyximport; pyximport.install()
+
+import CRADLE.CorrectBiasStored.correctReadCounts as crc
+
+@pytest.mark.parametrize("positionCount,blockSize,selected", [
+	(100, 16_384, [1, 1, 1, 1, 1, 1]),
+	(100, 7, [np.nan, 1, np.nan, 1, 1, 1]),
+	(1000, 64, [1, 1, np.nan, np.nan, np.nan, np.nan]),
+])
+def testPredictReadCounts(monkeypatch, positionCount, blockSize, selected):
+	monkeypatch.setattr(crc, "PREDICTION_BLOCK_SIZE", blockSize)
+	rng = np.random.default_rng(0)
+	selected = np.array(selected)
+
+	values = rng.random((positionCount, 6)).astype(np.float32)
+	values[rng.random((positionCount, 6)) < 0.05] = np.nan
+	coefs = rng.normal(0, 0.1, (3, 7))
+	coefs[:, 1:][:, np.isnan(selected)] = np.nan
+	coefHighrcs = rng.normal(0, 0.1, (3, 7))
+	coefHighrcs[:, 1:][:, np.isnan(selected)] = np.nan
+	highReadCountMask = rng.random(positionCount) < 0.2
+
+	covariateMatrix = values * selected
+	covariateMatrix[np.isnan(covariateMatrix)] = 0.0
+	prdvals = crc.predictReadCounts(covariateMatrix, highReadCountMask, *crc.coefMatrices(coefs), *crc.coefMatrices(coefHighrcs))
+
+	# The per-sample calculation predictReadCounts replaced
+	for sampleIdx in range(3):
+		expected = np.exp(np.nansum(values * selected * coefs[sampleIdx, 1:], axis=1) + coefs[sampleIdx, 0])
+		expected[highReadCountMask] = np.exp(
+			np.nansum(values[highReadCountMask] * selected * coefHighrcs[sampleIdx, 1:], axis=1) + coefHighrcs[sampleIdx, 0]
+		)
+		assert np.allclose(prdvals[:, sampleIdx], expected, rtol=1e-12)
@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+import pyBigWig
+import pytest
+import pyximport; pyximport.install()
+
+import CRADLE.CorrectBiasStored.regression as reg
+
+from CRADLE.correctbiasutils import ChromoRegion, ChromoRegionSet, process
+from CRADLE.CorrectBiasStored.vari import StoredCovariates
+
+@pytest.mark.parametrize("regions,blockSize,result", [
+	([("chr1", 0, 10)], 20, [[("chr1", 0, 10)]]),
+	([("chr1", 0, 10), ("chr2", 5, 15)], 10, [[("chr1", 0, 10)], [("chr2", 5, 15)]]),
+	([("chr1", 0, 10), ("chr2", 5, 15)], 15, [[("chr1", 0, 10), ("chr2", 5, 10)], [("chr2", 10, 15)]]),
+	([("chr1", 0, 25)], 10, [[("chr1", 0, 10)], [("chr1", 10, 20)], [("chr1", 20, 25)]]),
+])
+def testSplitTrainingSet(regions, blockSize, result):
+	trainingSet = ChromoRegionSet([ChromoRegion(*region) for region in regions])
+	blocks = reg.splitTrainingSet(trainingSet, blockSize)
+	assert [[(region.chromo, region.start, region.end) for region in block] for block in blocks] == result
+	assert sum(block.cumulativeRegionSize for block in blocks) == trainingSet.cumulativeRegionSize
+
+def regressionData(tmp_path):
+	chromoLengths = {"chr1": 3_000, "chr2": 2_000}
+	rng = np.random.default_rng(0)
+
+	covariDir = tmp_path / "test_fragLen10_kmer5"
+	covariDir.mkdir()
+	for chromo, length in chromoLengths.items():
+		with h5py.File(covariDir / f"test_fragLen10_kmer5_{chromo}.hdf5", "w") as f:
+			f.create_dataset("covari", data=rng.random((length, 6), dtype=np.float32))
+
+	bwNames = []
+	for i in range(3):
+		bwName = str(tmp_path / f"sample{i}.bw")
+		with pyBigWig.open(bwName, "w") as bwFile:
+			bwFile.addHeader(list(chromoLengths.items()))
+			for chromo, length in chromoLengths.items():
+				bwFile.addEntries(chromo, 0, values=rng.poisson(20 + 5 * i, length).astype(float).tolist(), span=1, step=1)
+		bwNames.append(bwName)
+
+	trainingSet = ChromoRegionSet([ChromoRegion("chr1", 100, 1_300), ChromoRegion("chr1", 2_000, 2_900), ChromoRegion("chr2", 10, 1_500)])
+	covariates = StoredCovariates(["shear", "pcr"], str(covariDir))
+	scatterplotSamples = rng.choice(trainingSet.cumulativeRegionSize, 50, replace=False)
+	return (trainingSet, covariates, bwNames[:1], [1.0], bwNames[1:], [1.1, 0.9], scatterplotSamples)
+
+def assertSameRegression(expected, result):
+	for expectedCoefs, coefs in zip(expected[:2], result[:2]):
+		assert np.allclose(expectedCoefs, coefs, rtol=1e-6, equal_nan=True)
+	for expectedPlotValues, plotValues in zip(expected[2:], result[2:]):
+		for bwName, (readCounts, fittedValues) in expectedPlotValues.items():
+			assert np.array_equal(plotValues[bwName][0], readCounts)
+			assert np.allclose(plotValues[bwName][1], fittedValues, rtol=1e-6)
+
+def testStreamedRegression(tmp_path, monkeypatch):
+	args = regressionData(tmp_path)
+
+	inMemory = reg.performRegression(*args)
+
+	monkeypatch.setattr(reg, "IN_MEMORY_REGRESSION_MAX_SIZE", 1_000)
+	monkeypatch.setattr(reg, "STREAMED_REGRESSION_BLOCK_SIZE", 700)
+	streamed = reg.performRegression(*args)
+
+	assertSameRegression(inMemory, streamed)
+
+@pytest.mark.parametrize("sampleGroups", [[[0, 1, 2]], [[0], [1, 2]], [[0], [1], [2]]])
+def testSharedRegressionTasks(tmp_path, sampleGroups):
+	trainingSet, covariates, ctrlBWNames, ctrlScaler, experiBWNames, experiScaler, scatterplotSamples = regressionData(tmp_path)
+	bwFileNames = ctrlBWNames + experiBWNames
+	scalers = ctrlScaler + experiScaler
+
+	sharedX = reg.sharedCovariateMatrix(trainingSet, covariates)
+	try:
+		assert np.array_equal(sharedX.array, reg.getCovariateMatrix(trainingSet, covariates))
+		taskResults = process(len(sampleGroups), reg.fitSamplesTask, [
+			(trainingSet, covariates, sharedX.descriptor, [bwFileNames[i] for i in group], [scalers[i] for i in group], scatterplotSamples)
+			for group in sampleGroups
+		])
+	finally:
+		sharedX.close()
+
+	sampleResults = [sampleResult for groupResults in taskResults for sampleResult in groupResults]
+	assertSameRegression(
+		reg.performRegression(trainingSet, covariates, ctrlBWNames, ctrlScaler, experiBWNames, experiScaler, scatterplotSamples),
+		reg.collectResults(sampleResults, ctrlBWNames, experiBWNames)
+	)
@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils import covariateStore
+
+@pytest.mark.parametrize("name,result", [
+	("hg38_fragLen300_kmer36", (300, 36)),
+	("hg38_fragLen1000_kmer100", (1000, 100)),
+	("CRADLE_covariates", (None, None)),
+])
+def testParseStoreName(name, result):
+	assert covariateStore.parseStoreName(name) == result
+
+@pytest.mark.parametrize("chunkRows", [3, 1000])
+def testConvertHDF5Store(tmp_path, monkeypatch, chunkRows):
+	monkeypatch.setattr(covariateStore, "CONVERT_CHUNK_ROWS", chunkRows)
+	hdf5Dir = tmp_path / "test_fragLen200_kmer50"
+	hdf5Dir.mkdir()
+
+	rng = np.random.default_rng(0)
+	chromoValues = {"chr1": rng.random((17, 6), dtype=np.float32), "chr2": rng.random((5, 6), dtype=np.float32)}
+	chromoValues["chr1"][3, 2] = np.nan
+	for chromo, values in chromoValues.items():
+		with h5py.File(covariateStore.hdf5FileName(str(hdf5Dir), chromo), "w") as f:
+			f.create_dataset("covari", data=values, compression="gzip")
+
+	assert not covariateStore.isNpyStore(str(hdf5Dir))
+	covariateStore.convertHDF5Store(str(hdf5Dir), str(hdf5Dir))
+	assert covariateStore.isNpyStore(str(hdf5Dir))
+
+	header = covariateStore.readHeader(str(hdf5Dir))
+	assert header["fragLen"] == 200
+	assert header["kmer"] == 50
+	assert header["chromosomes"] == {"chr1": 17, "chr2": 5}
+
+	for chromo, values in chromoValues.items():
+		with covariateStore.CovariateFile(covariateStore.npyFileName(str(hdf5Dir), chromo), "npy") as covariateFile:
+			assert np.array_equal(covariateFile.values[2:4], values[2:4], equal_nan=True)
+			assert np.array_equal(covariateFile.values[:], values, equal_nan=True)
@@ -0,0 +1,97 @@
+import pytest
+import pyximport; pyximport.install()
+
+import numpy as np
+import statsmodels.api as sm
+
+from CRADLE.correctbiasutils import glm
+
+def poissonData(rowCount, seed):
+	rng = np.random.default_rng(seed)
+	X = np.ones((rowCount, 4), dtype=np.float64)
+	X[:, 1] = rng.uniform(-20, 5, rowCount)
+	X[:, 2] = rng.uniform(0, 1, rowCount)
+	X[:, 3] = rng.uniform(-1000, -200, rowCount)
+	y = rng.poisson(np.exp(X @ np.array([2.5, 0.05, -1.0, 0.001]))).astype(np.float64)
+	return y, X
+
+def statsmodelsFit(y, X):
+	return sm.GLM(y.astype(int), X, family=sm.families.Poisson()).fit()
+
+@pytest.mark.parametrize("rowCount,seed", [(50, 0), (5_000, 1), (glm.IRLS_BLOCK_SIZE + 17, 2)])
+def testFitPoisson(rowCount, seed):
+	y, X = poissonData(rowCount, seed)
+	expected = statsmodelsFit(y, X)
+
+	result = glm.fitPoisson(y, X)
+	assert result.converged
+	assert result.params == pytest.approx(expected.params, rel=1e-6)
+	assert result.fittedvalues == pytest.approx(expected.fittedvalues, rel=1e-6)
+	assert result.deviance == pytest.approx(expected.deviance, rel=1e-9)
+
+def testFitPoissonWarmStart():
+	y, X = poissonData(2_000, 3)
+	coldStart = glm.fitPoisson(y, X)
+
+	warmStart = glm.fitPoisson(y, X, startParams=coldStart.params * 1.01)
+	assert warmStart.converged
+	assert warmStart.iterations <= coldStart.iterations
+	assert warmStart.params == pytest.approx(coldStart.params, rel=1e-6)
+
+def testFitPoissonFloat32():
+	y, X = poissonData(2_000, 4)
+	expected = statsmodelsFit(y, X.astype(np.float32).astype(np.float64))
+
+	result = glm.fitPoisson(y, X.astype(np.float32))
+	assert result.params == pytest.approx(expected.params, rel=1e-6)
+
+def testFitPoissonRankDeficient():
+	# A repeated column: like statsmodels, the fit still converges, to the minimum norm coefficients
+	y, X = poissonData(1_000, 5)
+	X = np.column_stack([X, X[:, 2]])
+	expected = statsmodelsFit(y, X)
+
+	result = glm.fitPoisson(y, X)
+	assert result.converged
+	assert result.params == pytest.approx(expected.params, rel=1e-5)
+	assert result.params[2] == pytest.approx(result.params[4])
+
+def testFitPoissonIterationLimit():
+	y, X = poissonData(1_000, 6)
+	result = glm.fitPoisson(y, X, maxIterations=1)
+	assert result.iterations == 1
+	assert not result.converged
+
+@pytest.mark.parametrize("responseCount", [1, 2, glm.SHARED_PRODUCTS_MIN_RESPONSES, 6])
+def testFitPoissonBatch(responseCount):
+	_, X = poissonData(3_000, 0)
+	rng = np.random.default_rng(responseCount)
+	responses = [rng.poisson(np.exp(X @ np.array([2.0 + 0.2 * i, 0.05, -1.0, 0.001]))).astype(np.float64) for i in range(responseCount)]
+
+	results = glm.fitPoissonBatch(np.column_stack(responses), X)
+	assert len(results) == responseCount
+	for y, result in zip(responses, results):
+		expected = statsmodelsFit(y, X)
+		assert result.converged
+		assert result.iterations == expected.fit_history['iteration']
+		assert result.params == pytest.approx(expected.params, rel=1e-6)
+		assert result.fittedvalues == pytest.approx(expected.fittedvalues, rel=1e-6)
+
+@pytest.mark.parametrize("blockSize", [1_000, 2_999, 10_000])
+def testFitPoissonStreamed(blockSize):
+	_, X = poissonData(3_000, 7)
+	rng = np.random.default_rng(blockSize)
+	Y = np.column_stack([rng.poisson(np.exp(X @ np.array([1.5 + 0.5 * i, 0.05, -1.0, 0.001]))) for i in range(4)]).astype(np.float64)
+
+	def blocks(includeX):
+		for blockStart in range(0, len(Y), blockSize):
+			yield Y[blockStart:blockStart + blockSize], (X[blockStart:blockStart + blockSize] if includeX else None)
+
+	fittedRows = rng.choice(len(Y), 40, replace=False)
+	results = glm.fitPoissonStreamed(blocks, Y.shape[1], fittedRows=fittedRows)
+	for expected, result in zip(glm.fitPoissonBatch(Y, X), results):
+		assert result.converged
+		assert result.iterations == expected.iterations
+		assert result.params == pytest.approx(expected.params, rel=1e-6)
+		assert result.deviance == pytest.approx(expected.deviance, rel=1e-9)
+		assert result.fittedvalues == pytest.approx(expected.fittedvalues[fittedRows], rel=1e-6)
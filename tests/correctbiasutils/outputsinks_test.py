@@ -0,0 +1,40 @@
+import h5py
+import numpy as np
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils.outputSinks import mergeCorrectedFilesToBedGraph, openCorrectedReadsWriter, outputArrayChunkFile
+
+sections = [
+	(np.array([10, 11, 20]), np.array([11, 15, 21]), np.array([1.0, -2.0, 3.0])),
+	(np.array([100, 105]), np.array([101, 110]), np.array([7.0, 1234567.0])),
+]
+
+def writeSections(outputFormat, outputDir):
+	writer = openCorrectedReadsWriter(outputFormat, outputDir, "chr1", 0, "/data/sample.bw")
+	for starts, ends, values in sections:
+		writer.write(len(starts), starts, ends, values)
+	writer.close()
+
+def testBedGraph(tmp_path):
+	writeSections("bedgraph", str(tmp_path))
+	outputFile = str(tmp_path / "sample_corrected.bedGraph")
+	mergeCorrectedFilesToBedGraph("/data/sample.bw", [("chr1", 1000)], [("chr1", 0)], outputFile, str(tmp_path))
+
+	with open(outputFile) as bedGraph:
+		assert bedGraph.read() == "chr1\t10\t11\t1\nchr1\t11\t15\t-2\nchr1\t20\t21\t3\nchr1\t100\t101\t7\nchr1\t105\t110\t1234567\n"
+	assert not (tmp_path / "sample_chr1_0_corrected.tmp").exists()
+
+@pytest.mark.parametrize("outputFormat", ["npz", "hdf5"])
+def testArrayChunks(tmp_path, outputFormat):
+	writeSections(outputFormat, str(tmp_path))
+	chunkFile = outputArrayChunkFile(str(tmp_path), "chr1", 0, "/data/sample.bw", outputFormat)
+
+	if outputFormat == "npz":
+		chunk = np.load(chunkFile)
+	else:
+		chunk = h5py.File(chunkFile, "r")
+
+	assert np.array_equal(chunk["start"][:], np.concatenate([starts for starts, _, _ in sections]))
+	assert np.array_equal(chunk["end"][:], np.concatenate([ends for _, ends, _ in sections]))
+	assert np.array_equal(chunk["value"][:], np.concatenate([values for _, _, values in sections]))
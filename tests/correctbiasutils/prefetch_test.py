@@ -0,0 +1,36 @@
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils.prefetch import Prefetcher
+
+def square(x):
+	return x * x
+
+def failAtThree(x):
+	if x == 3:
+		raise ValueError("3")
+	return x
+
+@pytest.mark.parametrize("depth", [0, 1, 2, 10])
+def testPrefetcher(depth):
+	prefetcher = Prefetcher(square, [(x,) for x in range(20)], depth)
+	assert list(prefetcher) == [x * x for x in range(20)]
+	assert prefetcher.stallTime >= 0
+	assert prefetcher.loadTime >= 0
+
+@pytest.mark.parametrize("depth", [0, 2])
+def testPrefetcherEmpty(depth):
+	assert list(Prefetcher(square, [], depth)) == []
+
+@pytest.mark.parametrize("depth", [0, 2])
+def testPrefetcherError(depth):
+	results = []
+	with pytest.raises(ValueError):
+		for result in Prefetcher(failAtThree, [(x,) for x in range(10)], depth):
+			results.append(result)
+	assert results == [0, 1, 2]
+
+def testPrefetcherStopEarly():
+	prefetcher = iter(Prefetcher(square, [(x,) for x in range(100)], 1))
+	assert next(prefetcher) == 0
+	prefetcher.close()
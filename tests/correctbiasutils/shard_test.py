@@ -0,0 +1,37 @@
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils.shard import ShardException, parseShard, shardRegions
+
+regions = [('chr1', 0, 100), ('chr1', 100, 200), ('chr1', 200, 300), ('chr2', 0, 50), ('chr2', 50, 100), ('chr3', 0, 400)]
+
+@pytest.mark.parametrize("shard,result", [
+	(None, None),
+	("1/1", (1, 1)),
+	("2/4", (2, 4)),
+	("4/4", (4, 4)),
+])
+def testParseShard(shard, result):
+	assert parseShard(shard) == result
+
+@pytest.mark.parametrize("shard", ["0/4", "5/4", "1/0", "1", "a/b", "1/2/3"])
+def testParseShardInvalid(shard):
+	with pytest.raises(ShardException):
+		parseShard(shard)
+
+@pytest.mark.parametrize("shardIndex,shardCount,result", [
+	(1, 1, regions),
+	(1, 2, [('chr1', 0, 100), ('chr1', 100, 200), ('chr1', 200, 300), ('chr2', 0, 50), ('chr2', 50, 100)]),
+	(2, 2, [('chr3', 0, 400)]),
+	(1, 3, [('chr1', 0, 100), ('chr1', 100, 200), ('chr1', 200, 300)]),
+	(2, 3, [('chr2', 0, 50), ('chr2', 50, 100)]),
+	(3, 3, [('chr3', 0, 400)]),
+])
+def testShardRegions(shardIndex, shardCount, result):
+	assert shardRegions(regions, shardIndex, shardCount) == result
+
+@pytest.mark.parametrize("shardCount", [1, 2, 3, 7, 20])
+def testShardRegionsPartition(shardCount):
+	# Every region is in exactly one shard and concatenating the shards keeps the original order
+	shards = [shardRegions(regions, shardIndex, shardCount) for shardIndex in range(1, shardCount + 1)]
+	assert [region for shard in shards for region in shard] == regions
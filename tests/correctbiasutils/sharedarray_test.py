@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+import pyximport; pyximport.install()
+
+from CRADLE.correctbiasutils import process
+from CRADLE.correctbiasutils.sharedArray import SharedArray
+
+def columnSum(descriptor, column):
+	sharedArray = SharedArray.attach(descriptor)
+	try:
+		return float(sharedArray.array[:, column].sum())
+	finally:
+		sharedArray.close()
+
+@pytest.mark.parametrize("shape", [(100, 3), (0, 3)])
+def testSharedArray(shape):
+	values = np.arange(np.prod(shape), dtype=np.float64).reshape(shape)
+	with SharedArray.create(shape, np.float64) as sharedArray:
+		sharedArray.array[:] = values
+		sums = process(2, columnSum, [(sharedArray.descriptor, column) for column in range(shape[1])])
+
+	assert sums == [float(values[:, column].sum()) for column in range(shape[1])]